@@ -1,10 +1,122 @@
-import re
+import textwrap
+from functools import lru_cache
 from typing import List, Dict, Optional, Union
+from pydantic import BaseModel, Field
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from llm import get_llm
+from llm import TEMPERATURE, build_llm
+from llm_manager import get_current_key, get_current_model
+from llm_cache import SemanticCache, make_key
+
+# Shared across calls so repeated analyses of the same case skip the LLM
+_analysis_cache = SemanticCache(threshold=0.95, ttl=24 * 60 * 60)
+
+INSUFFICIENT_DATA_RESPONSE = "### Outcome\nInsufficient information to analyze.\n"
+
+# Static instructions: no template variables, so every call shares the same prefix
+ANALYSIS_INSTRUCTIONS = textwrap.dedent("""
+            You are a legal expert reviewing a decided case. Evaluate the user's arguments against the judge's verdict and give constructive feedback.
+
+            Decide the outcome strictly from the verdict: which petitions or applications were granted or denied, which orders were made for or against each party, and who benefits. A verdict favoring the user's side means the user WON; a verdict favoring the other side means the user LOST.
+
+            Fill in:
+            - outcome: whether the user won or lost the case.
+            - reasoning: why, grounded in the verdict's orders and their legal implications.
+            - mistakes: the mistakes or weaknesses in each of the user's arguments, one entry per argument.
+            - suggestions: actionable improvements for each argument, one entry per argument.
+""").strip()
+
+# Per-case inputs, sent as a separate message after the static instructions
+ANALYSIS_INPUTS = textwrap.dedent("""
+            CASE TITLE: {title}
+            CASE DETAILS: {case_details}
+
+            USER'S ROLE: {user_role}
+            AI'S ROLE: {ai_role}
+            
+            DEFENDANT'S ARGUMENTS:
+            {defendant_args}
+
+            PLAINTIFF'S ARGUMENTS:
+            {plaintiff_args}
+
+            JUDGE'S VERDICT: {judges_verdict}
+""").strip()
+
+ANALYSIS_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", ANALYSIS_INSTRUCTIONS),
+    ("human", ANALYSIS_INPUTS)
+])
+
+class AnalysisResult(BaseModel):
+    """Structured analysis returned by the LLM."""
+    outcome: str = Field(description="Whether the user won or lost the case")
+    reasoning: str = Field(description="Reasoning for the outcome based on the arguments and verdict")
+    mistakes: List[str] = Field(description="Mistakes or weaknesses in each of the user's arguments")
+    suggestions: List[str] = Field(description="Actionable suggestions to improve each argument")
+
+def _to_markdown(result: AnalysisResult) -> str:
+    """Render an AnalysisResult in the Markdown layout callers expect."""
+    mistakes = "\n".join(f"- {item}" for item in result.mistakes) or "- None"
+    suggestions = "\n".join(f"- {item}" for item in result.suggestions) or "- None"
+    return (
+        f"### Outcome\n{result.outcome}\n\n"
+        f"### Reasoning\n{result.reasoning}\n\n"
+        f"### Mistakes\n{mistakes}\n\n"
+        f"### Suggestions\n{suggestions}"
+    )
+
+@lru_cache(maxsize=1)
+def _get_chain(model: str, api_key: str):
+    """Analysis chain for a model/key pair; rebuilt only after a rotation."""
+    return ANALYSIS_PROMPT | build_llm(model, api_key).with_structured_output(AnalysisResult)
+
+def _cache_keys(defendant_args, plaintiff_args, case_details, title, judges_verdict, user_role, ai_role):
+    """Exact cache key, similarity text and namespace for an analysis request.
+
+    Similarity matches are confined to the same roles, arguments and verdict,
+    which decide the critique and the outcome; only the wording of the title
+    and case details may differ.
+    """
+    payload = {
+        "model": get_current_model(),
+        "temperature": TEMPERATURE,
+        "title": title,
+        "case_details": case_details,
+        "user_role": user_role,
+        "ai_role": ai_role,
+        "defendant_args": sorted(defendant_args or []),
+        "plaintiff_args": sorted(plaintiff_args or []),
+        "judges_verdict": judges_verdict,
+    }
+    payload_text = "\n".join([title or "", case_details or ""])
+    namespace = (user_role, ai_role, make_key({
+        "defendant_args": payload["defendant_args"],
+        "plaintiff_args": payload["plaintiff_args"],
+        "judges_verdict": judges_verdict,
+    }))
+    return make_key(payload), payload_text, namespace
+
+def _is_trivial(defendant_args, plaintiff_args, judges_verdict) -> bool:
+    """True when there is too little material for a meaningful analysis."""
+    args = (defendant_args or []) + (plaintiff_args or [])
+    return not judges_verdict and (len(args) < 2 or sum(map(len, args)) < 200)
+
+def _prompt_inputs(defendant_args, plaintiff_args, case_details, title, judges_verdict, user_role, ai_role):
+    """Template variables for ANALYSIS_PROMPT."""
+    return {
+        "title": title or "Untitled",
+        "case_details": case_details or "No details provided.",
+        "user_role": user_role.upper() if user_role else "Not specified",
+        "ai_role": ai_role.upper() if ai_role else "Not specified",
+        "defendant_args": "\n".join(defendant_args) if defendant_args else "None",
+        "plaintiff_args": "\n".join(plaintiff_args) if plaintiff_args else "None",
+        "judges_verdict": judges_verdict or "No verdict provided",
+    }
 
 class CaseAnalysisService:
+    # Number of requests answered without an LLM call because the input was trivial
+    trivial_skips = 0
+
     @staticmethod
     def analyze_case(defendant_args: List[str], plaintiff_args: List[str] = None, case_details: str = None, title: Optional[str] = None, judges_verdict: str = None, user_role: str = None, ai_role: str = None) -> Dict[str, Union[List[str], str]]:
         """Uses LLM to analyze the user's arguments and provides suggestions for improvement.
@@ -20,70 +132,51 @@ class CaseAnalysisService:
         if not (defendant_args or plaintiff_args):
             return "No analysis generated."
 
-        prompt = f"""
-            You are a legal expert AI tasked with analyzing a legal case. Your role is to evaluate the arguments presented and provide constructive feedback.
+        # Without a verdict, one argument or a few short ones give nothing to analyze
+        if _is_trivial(defendant_args, plaintiff_args, judges_verdict):
+            CaseAnalysisService.trivial_skips += 1
+            return INSUFFICIENT_DATA_RESPONSE
 
-            CASE TITLE: {title or 'Untitled'}
-            CASE DETAILS: {case_details or 'No details provided.'}
+        request = (defendant_args, plaintiff_args, case_details, title, judges_verdict, user_role, ai_role)
+        exact_key, payload_text, namespace = _cache_keys(*request)
+        cached = _analysis_cache.get(exact_key, payload_text, namespace)
+        if cached is not None:
+            return cached
 
-            USER'S ROLE: {user_role.upper() if user_role else 'Not specified'}
-            AI'S ROLE: {ai_role.upper() if ai_role else 'Not specified'}
-            
-            DEFENDANT'S ARGUMENTS:
-            {chr(10).join(defendant_args) if defendant_args else 'None'}
-
-            PLAINTIFF'S ARGUMENTS:
-            {chr(10).join(plaintiff_args) if plaintiff_args else 'None'}
-
-            JUDGE'S VERDICT: {judges_verdict or 'No verdict provided'}
-
-            IMPORTANT VERDICT ANALYSIS INSTRUCTIONS:
-            1. First, carefully analyze who the verdict favors by examining:
-               - The outcome of petitions/applications
-               - Which party's requests were granted or denied
-               - Any orders for/against specific parties
-               - The implications for each party
-            
-            2. Then determine if the user won or lost:
-               - If user is PLAINTIFF:
-                 * A verdict favoring the plaintiff means the user WON
-                 * A verdict favoring the defendant means the user LOST
-               
-               - If user is DEFENDANT:
-                 * A verdict favoring the plaintiff means the user LOST
-                 * A verdict favoring the defendant means the user WON
-            
-            3. Base your analysis STRICTLY on:
-               - The specific language and orders in the verdict
-               - Legal implications of those orders
-               - Which party benefits from the outcome
+        try:
+            chain = _get_chain(get_current_model(), get_current_key())
+            response = _to_markdown(chain.invoke(_prompt_inputs(*request)))
 
-            Required sections for your analysis:
+            _analysis_cache.set(exact_key, response, payload_text, namespace)
+            return response
 
-            Return your response as a well-structured Markdown document with the following sections:
-            
-            ### Outcome
-            Clearly state whether the user has won or lost the case.
+        except Exception as e:
+            print(f"Error during LLM analysis: {e}")
+            error_message = f"Internal error during analysis: {e}"
+            return "Error in Generating Analysis: " + error_message
 
-            ### Reasoning
-            Provide detailed reasoning for the outcome based on the arguments and verdict.
+    @staticmethod
+    async def analyze_case_async(defendant_args: List[str], plaintiff_args: List[str] = None, case_details: str = None, title: Optional[str] = None, judges_verdict: str = None, user_role: str = None, ai_role: str = None) -> Dict[str, Union[List[str], str]]:
+        """Async variant of analyze_case that awaits the LLM without blocking the event loop."""
+        if not (defendant_args or plaintiff_args):
+            return "No analysis generated."
 
-            ### Mistakes
-            Analyze each and every argument made by the user. Identify mistakes or weaknesses in each of the user's arguments as a bulleted list.
+        # Without a verdict, one argument or a few short ones give nothing to analyze
+        if _is_trivial(defendant_args, plaintiff_args, judges_verdict):
+            CaseAnalysisService.trivial_skips += 1
+            return INSUFFICIENT_DATA_RESPONSE
 
-            ### Suggestions
-            Provide actionable suggestions for improvement in each argument as a bulleted list.
-        """
-        analysis_prompt = ChatPromptTemplate.from_messages([
-            ("system", prompt)
-        ])
+        request = (defendant_args, plaintiff_args, case_details, title, judges_verdict, user_role, ai_role)
+        exact_key, payload_text, namespace = _cache_keys(*request)
+        cached = _analysis_cache.get(exact_key, payload_text, namespace)
+        if cached is not None:
+            return cached
 
         try:
-            chain = analysis_prompt | get_llm() | StrOutputParser()
-            response = chain.invoke({})
+            chain = _get_chain(get_current_model(), get_current_key())
+            response = _to_markdown(await chain.ainvoke(_prompt_inputs(*request)))
 
-            response = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
-            
+            _analysis_cache.set(exact_key, response, payload_text, namespace)
             return response
 
         except Exception as e:
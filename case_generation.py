@@ -1,3 +1,4 @@
+import asyncio
 import random
 import string
 import re
@@ -76,9 +77,8 @@ async def generate_case(sections: int, numbers: list[int]) -> dict:
     ipc_section_numbers_str = ", ".join(map(str, numbers)) if numbers else "XXX"  # Default if no numbers provided
     number_of_ipc_sections = sections
 
-    # Generate random names and cities
-    names = await random_names()
-    cities = await random_cities()
+    # Generate random names and cities; the two calls are independent, so run them together
+    names, cities = await asyncio.gather(random_names(), random_cities())
 
     # Select a few random names and a random city
     selected_names = random.sample(names, min(len(names), 3)) if names else ["Parth Rana", "Pranav Nagvekar", "Prasiddhi Agarwal", "Yashvi Savla"]
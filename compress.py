@@ -0,0 +1,60 @@
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Iterable, List
+import tiktoken
+
+_WORD_RE = re.compile(r"[a-z]{3,}")
+
+@lru_cache(maxsize=1)
+def _encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+# History blocks are re-measured on every turn; only the newest one is new
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Number of cl100k_base tokens in text."""
+    return len(_encoding().encode(text, disallowed_special=()))
+
+def _salience(blocks: List[str], query_terms: Iterable[str]) -> List[float]:
+    """TF-IDF weight of the query terms in each block, plus a small recency bonus."""
+    term_counts = [Counter(_WORD_RE.findall(block.lower())) for block in blocks]
+    document_frequency = Counter(term for counts in term_counts for term in counts)
+    query = set(query_terms)
+    n = len(blocks)
+
+    scores = []
+    for position, counts in enumerate(term_counts):
+        total = sum(counts.values()) or 1
+        weight = sum(
+            (counts[term] / total) * (1 + math.log((n + 1) / (document_frequency[term] + 1)))
+            for term in query if term in counts
+        )
+        # Later arguments respond to earlier ones, so break ties towards recency
+        scores.append(weight + 0.1 * position / n)
+    return scores
+
+def select_blocks(blocks: List[str], max_tokens: int, keywords: str = "") -> List[int]:
+    """Indices of the blocks to keep so their total fits roughly max_tokens.
+
+    The first block (case context) and the last block (most recent argument)
+    are always kept. The remaining blocks are ranked by TF-IDF overlap with
+    `keywords` and packed greedily into the budget. Indices are returned in
+    their original order.
+    """
+    sizes = [count_tokens(block) for block in blocks]
+    if sum(sizes) <= max_tokens or len(blocks) <= 2:
+        return list(range(len(blocks)))
+
+    keep = {0, len(blocks) - 1}
+    budget = max_tokens - sizes[0] - sizes[-1]
+
+    query_terms = _WORD_RE.findall(keywords.lower())
+    middle = range(1, len(blocks) - 1)
+    scores = _salience(blocks, query_terms)
+    for index in sorted(middle, key=lambda i: scores[i], reverse=True):
+        if sizes[index] <= budget:
+            keep.add(index)
+            budget -= sizes[index]
+    return sorted(keep)
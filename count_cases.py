@@ -1,50 +1,44 @@
-import os
 import csv
-from pymongo import MongoClient
-from dotenv import load_dotenv
+import asyncio
+import logging
+from db_client import get_client, get_db
+from logging_setup import setup_logging
 
-# Load environment variables
-load_dotenv()
-MONGODB_URL = os.getenv("MONGODB_URL")
-DB_NAME = "ai_courtroom"
-COLLECTION_NAME = "cases"
+logger = logging.getLogger(__name__)
 
-def count_cases_by_section():
-    client = None
+COLLECTION_NAME = "cases"
+CSV_BUFFER_SIZE = 1 << 20  # 1 MiB write buffer for CSV exports
+AGGREGATE_BATCH_SIZE = 1000  # Documents fetched per cursor round-trip
+
+def export_counts(cases_collection, pipeline, csv_file_path, header, to_row):
+    """Stream an aggregation cursor straight into a CSV file.
+
+    Returns False without creating the file when the aggregation is empty.
+    """
+    cursor = cases_collection.aggregate(pipeline, batchSize=AGGREGATE_BATCH_SIZE)
+    first = next(cursor, None)
+    if first is None:
+        return False
+
+    with open(csv_file_path, mode='w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerow(to_row(first))
+        writer.writerows(map(to_row, cursor))
+    return True
+
+async def count_cases_by_section():
     try:
         # Connect to MongoDB
-        client = MongoClient(MONGODB_URL)
-        db = client[DB_NAME]
-        cases_collection = db[COLLECTION_NAME]
+        cases_collection = get_db()[COLLECTION_NAME]
 
-        print("Connected to MongoDB. Counting cases by section...")
+        logger.info("Counting cases by section, by status, and by section and status...")
 
         # Aggregate to count cases by section
         pipeline_section = [
             {"$group": {"_id": "$section", "count": {"$sum": 1}}},
             {"$sort": {"count": -1}}
         ]
-        
-        section_counts = list(cases_collection.aggregate(pipeline_section))
-
-        if not section_counts:
-            print("No cases found in the collection.")
-        else:
-            # Define CSV file path for sections
-            csv_file_path_sections = "case_counts_by_section.csv"
-
-            # Write to CSV
-            with open(csv_file_path_sections, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                writer.writerow(["Section", "Count"])
-                for item in section_counts:
-                    section_name = item.get("_id", "Unknown")
-                    count = item.get("count", 0)
-                    writer.writerow([section_name, count])
-            
-            print(f"Successfully exported case counts by section to {csv_file_path_sections}")
-
-        print("Counting cases by status...")
 
         # Aggregate to count cases by status
         pipeline_status = [
@@ -52,59 +46,52 @@ def count_cases_by_section():
             {"$sort": {"count": -1}}
         ]
 
-        status_counts = list(cases_collection.aggregate(pipeline_status))
-
-        if not status_counts:
-            print("No cases found with status.")
-        else:
-            # Define CSV file path for status
-            csv_file_path_status = "case_counts_by_status.csv"
-
-            # Write to CSV
-            with open(csv_file_path_status, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                writer.writerow(["Status", "Count"])
-                for item in status_counts:
-                    status_name = item.get("_id", "Unknown")
-                    count = item.get("count", 0)
-                    writer.writerow([status_name, count])
-            
-            print(f"Successfully exported case counts by status to {csv_file_path_status}")
-
-        print("Counting cases by section and status...")
-
-        # Aggregate to count cases by section and status
+        # Aggregate to count cases by section and status, flattening the
+        # group key server-side so each row is a plain lookup
         pipeline_section_status = [
             {"$group": {"_id": {"section": "$section", "status": "$status"}, "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}}
+            {"$sort": {"count": -1}},
+            {"$project": {"_id": 0, "section": "$_id.section", "status": "$_id.status", "count": 1}}
         ]
 
-        section_status_counts = list(cases_collection.aggregate(pipeline_section_status))
+        # (pipeline, CSV file path, header, row builder, label, empty message)
+        exports = [
+            (
+                pipeline_section, "case_counts_by_section.csv", ["Section", "Count"],
+                lambda doc: (doc.get("_id", "Unknown"), doc.get("count", 0)),
+                "section", "No cases found in the collection."
+            ),
+            (
+                pipeline_status, "case_counts_by_status.csv", ["Status", "Count"],
+                lambda doc: (doc.get("_id", "Unknown"), doc.get("count", 0)),
+                "status", "No cases found with status."
+            ),
+            (
+                pipeline_section_status, "case_counts_by_section_and_status.csv", ["Section", "Status", "Count"],
+                lambda doc: (doc.get("section", "Unknown"), doc.get("status", "Unknown"), doc.get("count", 0)),
+                "section and status", "No cases found with section and status."
+            ),
+        ]
 
-        if not section_status_counts:
-            print("No cases found with section and status.")
-        else:
-            # Define CSV file path for section and status
-            csv_file_path_section_status = "case_counts_by_section_and_status.csv"
+        # The aggregations are independent, so run them (and their CSV writes)
+        # side by side on worker threads; MongoClient is thread-safe
+        results = await asyncio.gather(*(
+            asyncio.to_thread(export_counts, cases_collection, pipeline, csv_file_path, header, to_row)
+            for pipeline, csv_file_path, header, to_row, _, _ in exports
+        ))
 
-            # Write to CSV
-            with open(csv_file_path_section_status, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                writer.writerow(["Section", "Status", "Count"])
-                for item in section_status_counts:
-                    section_name = item.get("_id", {}).get("section", "Unknown")
-                    status_name = item.get("_id", {}).get("status", "Unknown")
-                    count = item.get("count", 0)
-                    writer.writerow([section_name, status_name, count])
-            
-            print(f"Successfully exported case counts by section and status to {csv_file_path_section_status}")
+        for (_, csv_file_path, _, _, label, empty_message), exported in zip(exports, results):
+            if not exported:
+                logger.info(empty_message)
+            else:
+                logger.info(f"Successfully exported case counts by {label} to {csv_file_path}")
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if client:
-            client.close()
-            print("MongoDB connection closed.")
+        logger.error(f"An error occurred: {e}")
 
 if __name__ == "__main__":
-    count_cases_by_section()
\ No newline at end of file
+    setup_logging()
+    try:
+        asyncio.run(count_cases_by_section())
+    finally:
+        get_client().close()
@@ -0,0 +1,35 @@
+import os
+from functools import lru_cache
+from pymongo import MongoClient
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+MONGODB_URL = os.getenv("MONGODB_URL")  # Cloud MongoDB URL from .env
+DB_NAME = "ai_courtroom"
+# Connections per client; async callers run queries on worker threads, so
+# this also caps how many queries can be in flight at once
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+# Connections kept open between bursts so workers don't redo TLS handshakes
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "4"))
+
+@lru_cache(maxsize=1)
+def get_client() -> MongoClient:
+    """Return the process-wide MongoClient, creating it on first use.
+
+    Every script shares this client, so the TCP/TLS handshake and topology
+    discovery happen once and later operations reuse pooled connections.
+    """
+    return MongoClient(
+        MONGODB_URL,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=60_000,
+        serverSelectionTimeoutMS=5_000,
+        compressors="zstd,zlib",
+        retryWrites=True
+    )
+
+def get_db():
+    """Return the courtroom database on the shared client."""
+    return get_client()[DB_NAME]
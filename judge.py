@@ -1,16 +1,29 @@
+import asyncio
 import logging
+import random
 import re
+import textwrap
+from collections import Counter
 from typing import List
+from langchain_core.messages import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from llm import get_llm
+from llm_manager import is_transient_error
 logger = logging.getLogger(__name__)
 
-async def generate_verdict(plaintiff_args: List[str], defendant_args: List[str], case_details: str = None, title: str = None, llm=None) -> str:
-    try:
-        # Combine all arguments to create a history
-        history = "\n".join(plaintiff_args + defendant_args)
-        
-        judge_template = """
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+
+# Rubric violations found in a single pass over the verdict: stray question
+# marks and numbered paragraphs that hold only one sentence
+_VIOLATION_RE = re.compile(
+    r"(?P<question>\?)|(?P<short_paragraph>^\d+\.[ \t]+[^.?!\n]*[.!][ \t]*$)",
+    re.MULTILINE
+)
+
+# Static rubric: kept free of template variables so every call shares a
+# byte-identical prefix that provider-side prompt caches can reuse.
+STATIC_RUBRIC = textwrap.dedent("""
             You are an impartial Indian Court judge. Draft a formal JUDGMENT in the style used by Indian High Courts / Supreme Court practice, following the rules below.
 
             FORMATTING RULES (must be followed exactly):
@@ -24,7 +37,7 @@ async def generate_verdict(plaintiff_args: List[str], defendant_args: List[str],
             - **NO QUESTIONS:** Do not include any interrogative sentences or question marks ('?') anywhere in the judgment. Do not pose rhetorical questions. All sentences must be declarative or imperative as appropriate.
 
             DOCUMENT HEADER (include where available):
-            - **CASE TITLE:** {title}
+            - **CASE TITLE:** [Case Title from the inputs]
             - **COURT:** [Insert Court Name]
             - **CASE NO.:** [Insert if given]
             - **DATE OF JUDGMENT:** [DD Month YYYY]
@@ -93,34 +106,84 @@ async def generate_verdict(plaintiff_args: List[str], defendant_args: List[str],
             - Combine brief or related points into single, well-developed numbered paragraphs rather than creating several short numbered paragraphs. Each numbered paragraph (except permitted single-line findings and very short operative commands) must have a minimum of TWO sentences.
             - Absolutely no question marks ('?') must appear anywhere in the judgment. Replace any intended interrogative phrasing with a declarative restatement.
             - If the input materially conflicts or is insufficient, state the conflict or insufficiency as an "Assumption: ..." while still producing combined paragraphs that meet the minimum sentence rule.
+""").strip()
 
+# Per-case inputs, sent as a separate message after the static rubric
+DYNAMIC_TAIL = textwrap.dedent("""
             INPUTS PROVIDED:
+            Case Title: {title}
             Case Description: {case_details}
             Petitioner Arguments: {plaintiff_args}
             Respondent Arguments: {defendant_args}
-            Argument History: {history}
 
             Now draft the judgment strictly following the above headings, sequential paragraph numbering across the entire document (except FORMALITIES), and Indian judicial style. Ensure the judgment is clear, logically reasoned, avoids any questions, combines paragraphs where necessary to meet the minimum sentence requirement, and contains the exact sections: FACTS; ISSUES; PETITIONER'S ARGUMENTS; RESPONDENT'S ARGUMENTS; ANALYSIS OF THE LAW; COURT'S REASONING; FINDINGS / DECISION ON ISSUES; CONCLUSION; ORDER; FORMALITIES.
-        """
-
-        judge_prompt = ChatPromptTemplate.from_messages([
-            ("system", judge_template)
-        ])
-
-        judge_chain = judge_prompt | llm | StrOutputParser()
-
-        verdict = judge_chain.invoke({
-            "title": title or "No title provided",
-            "case_details": case_details or "No case details provided",
-            "history": history or "No argument history provided",
-            "plaintiff_args": plaintiff_args,
-            "defendant_args": defendant_args,
-        })
-
-        verdict = re.sub(r"<think>.*?</think>", "", verdict, flags=re.DOTALL).strip()
-
-        return verdict
-        
-    except Exception as e:
-        logger.error(f"Error generating verdict: {str(e)}")
-        return "I apologize, but I'm unable to generate a verdict at this time. Please try again later."
+""").strip()
+
+JUDGE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", STATIC_RUBRIC),
+    ("human", DYNAMIC_TAIL)
+])
+
+_OUTPUT_PARSER = StrOutputParser()
+
+VERDICT_UNAVAILABLE = "I apologize, but I'm unable to generate a verdict at this time. Please try again later."
+
+MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 2.0  # Seconds before the first retry; doubles after each
+
+def enforce_verdict_rules(verdict: str) -> str:
+    """Check a verdict against the rubric's mechanical rules and fix what is cheap to fix.
+
+    Question marks are rewritten as full stops. Single-sentence numbered
+    paragraphs are only logged, because the rubric permits them for findings
+    and short operative commands.
+    """
+    violations = Counter(match.lastgroup for match in _VIOLATION_RE.finditer(verdict))
+
+    if violations["short_paragraph"]:
+        logger.warning(f"Verdict has {violations['short_paragraph']} single-sentence numbered paragraph(s)")
+
+    if violations["question"]:
+        logger.warning(f"Verdict has {violations['question']} question mark(s); replacing with full stops")
+        verdict = verdict.replace("?", ".")
+
+    return verdict
+
+def build_prompt(plaintiff_args: List[str], defendant_args: List[str], case_details: str = None, title: str = None) -> List[BaseMessage]:
+    """Render the judge prompt for a case; the result can be reused for every model."""
+    return JUDGE_PROMPT.format_messages(
+        title=title or "No title provided",
+        case_details=case_details or "No case details provided",
+        plaintiff_args=plaintiff_args,
+        defendant_args=defendant_args,
+    )
+
+async def generate_verdict(plaintiff_args: List[str], defendant_args: List[str], case_details: str = None, title: str = None, llm=None, prompt: List[BaseMessage] = None) -> str:
+    """Draft a verdict, retrying transient LLM errors with jittered exponential backoff.
+
+    `prompt` is a prompt already rendered by build_prompt; the other case
+    arguments are ignored when it is given. `llm` defaults to the current
+    model and key. Returns VERDICT_UNAVAILABLE when every attempt fails.
+    """
+    judge_chain = (llm or get_llm()) | _OUTPUT_PARSER
+    inputs = prompt or build_prompt(plaintiff_args, defendant_args, case_details, title)
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            verdict = await judge_chain.ainvoke(inputs)
+            break
+        except Exception as e:
+            # A daily token limit won't lift within the backoff, so retrying the same key is wasted
+            daily_limit = "tokens per day" in str(e).lower()
+            if attempt < MAX_ATTEMPTS and is_transient_error(e) and not daily_limit:
+                delay = RETRY_BASE_DELAY * 2 ** (attempt - 1) * (1 + random.random())
+                logger.warning(f"Transient error generating verdict (attempt {attempt}/{MAX_ATTEMPTS}), retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"Error generating verdict: {str(e)}")
+            return VERDICT_UNAVAILABLE
+
+    verdict = _THINK_RE.sub("", verdict).strip()
+    verdict = enforce_verdict_rules(verdict)
+
+    return verdict
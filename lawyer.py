@@ -1,113 +1,291 @@
+import asyncio
 import logging
 import re
-from langchain_core.prompts import ChatPromptTemplate
+import textwrap
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, List, Tuple
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from llm import get_llm
+from compress import count_tokens, select_blocks
+from llm import TEMPERATURE, build_llm
+from llm_manager import get_current_model, is_transient_error, key_scheduler
+from llm_cache import SemanticCache, make_key
 
 logger = logging.getLogger(__name__)
 
-# ---- Argument Generation ----
-async def generate_counter_argument(history: str, last_argument: str, ai_role: str = None, user_role: str = None, case_details: str = None) -> str:
-    try:
-        template = '''You are an experienced and assertive Indian trial lawyer representing the {ai_role}. 
-        The opposing lawyer represents the {user_role}. 
-        The case details are: {case_details}
-        Argument history so far: {history} 
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
 
-        The last argument made was: "{last_argument}"
+# Multi-word capitalised phrases: party names, places, courts
+_ENTITY_RE = re.compile(r"\b[A-Z][a-z]+(?:\s+[A-Z][a-z]+)+\b")
 
-        Your task: Respond directly to the last argument in a logical and coherent manner. 
-        Build upon earlier arguments but do not repeat them. 
-        Keep the response under 200 words. 
+# Each stage's prompt opens with a static prefix free of template variables,
+# so every call for that stage shares a byte-identical start that provider-side
+# prompt caches can reuse; roles, case details and history follow it.
+COUNTER_STATIC_PREFIX = textwrap.dedent("""
+        You are an experienced and assertive Indian trial lawyer.
+        Your task: Respond directly to the last argument in a logical and coherent manner.
+        Build upon earlier arguments but do not repeat them.
+        Keep the response under 200 words.
         Don't add headings like "Counter Argument".
-        '''
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", template)
-        ]) 
+        The argument history so far follows: your earlier arguments as assistant messages, the opposing lawyer's as user messages.
+""").strip()
+
+COUNTER_DYNAMIC_SUFFIX = textwrap.dedent("""
+        You represent the {ai_role}. The opposing lawyer represents the {user_role}.
+        The case details are: {case_details}
+""").strip()
+
+COUNTER_TASK = 'The last argument made was: "{last_argument}"'
+
+OPENING_STATIC_PREFIX = textwrap.dedent("""
+        You are an Indian lawyer.
+        Provide a strong and concise opening statement (under 250 words) using the case details given.
+        Stay strictly within the facts of the case.
+        Do not add headings like "Opening Statement".
+""").strip()
+
+OPENING_DYNAMIC_SUFFIX = textwrap.dedent("""
+        You are from the {ai_role}'s side. The opposing lawyer represents the {user_role}.
+        The case details are: {case_details}
+""").strip()
+
+CLOSING_STATIC_PREFIX = textwrap.dedent("""
+        You are an Indian lawyer.
+        Provide a powerful closing statement (around 250 words) based on the full case history.
+        Summarize your strongest points and highlight evidence.
+        End your statement with: "I rest my case here".
+        Do not add headings like "Closing Statement".
+        The full case history follows: your earlier arguments as assistant messages, the opposing lawyer's as user messages.
+""").strip()
+
+CLOSING_DYNAMIC_SUFFIX = "You are from the {ai_role}'s side. The opposing lawyer represents the {user_role}."
+
+CLOSING_TASK = "Deliver your closing statement now."
+
+# Prompts by stage, parsed once at import and shared by every call. The
+# argument history is passed as chat messages rather than pasted into the
+# system prompt as one ever-growing string
+STAGE_PROMPTS = {
+    "opening": ChatPromptTemplate.from_messages([
+        ("system", OPENING_STATIC_PREFIX),
+        ("system", OPENING_DYNAMIC_SUFFIX)
+    ]),
+    "counter": ChatPromptTemplate.from_messages([
+        ("system", COUNTER_STATIC_PREFIX),
+        ("system", COUNTER_DYNAMIC_SUFFIX),
+        MessagesPlaceholder("history"),
+        ("human", COUNTER_TASK)
+    ]),
+    "closing": ChatPromptTemplate.from_messages([
+        ("system", CLOSING_STATIC_PREFIX),
+        ("system", CLOSING_DYNAMIC_SUFFIX),
+        MessagesPlaceholder("history"),
+        ("human", CLOSING_TASK)
+    ]),
+}
+
+_OUTPUT_PARSER = StrOutputParser()
+
+@lru_cache(maxsize=32)
+def _get_chain(stage: str, model: str, api_key: str):
+    """Chain for a stage and model/key pair; rebuilt only for a new pair.
+
+    The SQLite LLM cache would store rejected replies and replay them on
+    every retry, so lawyer calls rely on _response_cache, which only keeps
+    usable ones.
+    """
+    return STAGE_PROMPTS[stage] | build_llm(model, api_key) | _OUTPUT_PARSER
+
+async def _acquire_chain(stage: str, tokens: int = 0):
+    """Key and chain for a stage on the least recently used healthy key with room for `tokens`."""
+    api_key = await key_scheduler.acquire(tokens)
+    return api_key, _get_chain(stage, get_current_model(), api_key)
+
+def _prompt_tokens(stage: str, variables: dict) -> int:
+    """Token count of a rendered lawyer prompt; the static prefix and history turns are memoised."""
+    return sum(count_tokens(message.content) for message in STAGE_PROMPTS[stage].format_messages(**variables))
+
+# Token budget for the history sent with a closing statement
+HISTORY_TOKEN_BUDGET = 3000
+
+# Cosine similarity above which a cached response is reused for a new prompt
+SEMANTIC_THRESHOLD = 0.92
+
+# Responses reused for identical or near-identical prompts for a week
+_response_cache = SemanticCache(threshold=SEMANTIC_THRESHOLD, ttl=7 * 24 * 60 * 60, max_entries=10_000)
+
+def cache_stats() -> dict:
+    """Hit/miss counts of the lawyer response cache."""
+    return {"hits": _response_cache.hits, "misses": _response_cache.misses}
+
+# Phrases that mark an LLM fallback message rather than a real argument
+FALLBACK_PATTERNS = [
+    "i apologize",
+    "unable to",
+    "please try again later",
+    "failed after multiple retries"
+]
+_FALLBACK_RE = re.compile("|".join(map(re.escape, FALLBACK_PATTERNS)), re.IGNORECASE)
+
+def is_valid_response(text: str) -> bool:
+    """Check if LLM output is a real argument, not a fallback message."""
+    return bool(text) and _FALLBACK_RE.search(text) is None
+
+def _is_usable(response: str) -> bool:
+    """Reject fallback messages and truncated responses; only usable ones are cached."""
+    return is_valid_response(response) and len(response) >= 50
+
+@lru_cache(maxsize=256)
+def _entity_digest(text: str) -> str:
+    # Memoised: the same case details come back in every round of a case
+    return make_key({"entities": sorted(set(_ENTITY_RE.findall(text)))})
 
-        chain = prompt | get_llm() | StrOutputParser()
+def _entity_fingerprint(variables: dict) -> str:
+    """Digest of the named entities in the case the prompt is about."""
+    source = variables.get("case_details")
+    if source is None and variables.get("history"):
+        source = variables["history"][0].content
+    return _entity_digest(source or "")
 
-        response = chain.invoke({
+def _cache_lookup(stage: str, variables: dict):
+    """Cache key, similarity text and namespace for a rendered lawyer prompt.
+
+    Similarity is computed over the per-case variables only. Matches are
+    confined to the same stage, roles, round (history length) and named
+    entities, so the shared template wording cannot make two different cases
+    look alike and a reused answer never names the wrong parties.
+    """
+    rendered = "\n".join(message.content for message in STAGE_PROMPTS[stage].format_messages(**variables))
+    payload_text = "\n".join(
+        "\n".join(message.content for message in value) if name == "history" else str(value)
+        for name, value in variables.items() if name not in ("ai_role", "user_role")
+    )
+    namespace = (
+        stage, variables.get("ai_role"), variables.get("user_role"),
+        len(variables.get("history", ())), _entity_fingerprint(variables)
+    )
+    key = make_key({"model": get_current_model(), "temperature": TEMPERATURE, "prompt": rendered})
+    return key, payload_text, namespace
+
+async def _cached_ainvoke(stage: str, variables: dict) -> str:
+    """Answer a lawyer prompt from the response cache, or from the LLM on a miss."""
+    key, payload_text, namespace = _cache_lookup(stage, variables)
+    cached = _response_cache.get(key, payload_text, namespace)
+    if cached is not None:
+        logger.debug(f"Response cache hit for {stage} prompt {key[:12]}")
+        return cached
+
+    api_key, chain = await _acquire_chain(stage, _prompt_tokens(stage, variables))
+    try:
+        response = await chain.ainvoke(variables)
+    except Exception as e:
+        # Only this call knows which key failed
+        key_scheduler.report_error(api_key, e)
+        raise
+    response = _THINK_RE.sub("", response).strip()
+
+    if _is_usable(response):
+        _response_cache.set(key, response, payload_text, namespace)
+    return response
+
+def truncate_history(history: List[Tuple[str, str]], ai_role: str = "", user_role: str = "") -> List[Tuple[str, str]]:
+    """Compress an overlong history for the closing statement prompt."""
+    keep = select_blocks([text for _, text in history], HISTORY_TOKEN_BUDGET, keywords=f"{ai_role} {user_role}")
+    if len(keep) == len(history):
+        return history
+    logger.info(f"History too long ({len(history)} turns), kept {len(keep)} for closing statement")
+    return [history[index] for index in keep]
+
+def history_messages(history: List[Tuple[str, str]], ai_role: str) -> List[BaseMessage]:
+    """Chat messages for a history of (speaker, argument) turns, seen from ai_role's side."""
+    return [
+        AIMessage(content=text) if speaker == ai_role else HumanMessage(content=f"{speaker}: {text}")
+        for speaker, text in history
+    ]
+
+def _prompt_variables(stage: str, variables: dict) -> dict:
+    """Template variables for a stage, with the history turned into messages."""
+    if "history" not in variables:
+        return variables
+    history = variables["history"]
+    if stage == "closing":
+        history = truncate_history(history, variables.get("ai_role", ""), variables.get("user_role", ""))
+    return {**variables, "history": history_messages(history, variables.get("ai_role"))}
+
+# ---- Batched Generation ----
+async def run_pool(items: List, worker: Callable[[Any], Awaitable], concurrency: int = 16) -> List:
+    """Run `worker` over `items` with a steady number of calls in flight.
+
+    `concurrency` workers pull the next item from a queue as soon as their
+    previous call finishes, so one slow prompt never holds back a whole
+    wave. Results keep the order of `items`; the first error is raised once
+    every item has been attempted.
+    """
+    queue = asyncio.Queue()
+    for index, item in enumerate(items):
+        queue.put_nowait((index, item))
+    results = [None] * len(items)
+    errors = []
+
+    async def drain():
+        while not queue.empty():
+            index, item = queue.get_nowait()
+            try:
+                results[index] = await worker(item)
+            except Exception as e:
+                errors.append(e)
+
+    await asyncio.gather(*(drain() for _ in range(min(concurrency, len(items)))))
+    if errors:
+        raise errors[0]
+    return results
+
+# ---- Argument Generation ----
+async def generate_counter_argument(history: List[Tuple[str, str]], last_argument: str, ai_role: str = None, user_role: str = None, case_details: str = None) -> str:
+    try:
+        response = await _cached_ainvoke("counter", _prompt_variables("counter", {
             "ai_role": ai_role,
             "history": history,
             "case_details": case_details,
             "user_role": user_role,
             "last_argument": last_argument
-        })
-        
-        response = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
+        }))
         return response
     except Exception as e:
+        # Rate limits and provider hiccups go up to handle_rate_limit, which rests or rotates the key
+        if is_transient_error(e):
+            raise
         logger.error(f"Error generating counter argument: {str(e)}")
         return "I apologize, but I'm unable to generate a counter argument at this time. Please try again later."
 
 # ---- Opening Statement ----
 async def opening_statement(ai_role: str, case_details: str, user_role: str) -> str:
     try:
-        template = '''You are an Indian lawyer from the {ai_role}'s side. 
-        Provide a strong and concise opening statement (under 250 words) using these case details: {case_details}. 
-        The opposing lawyer represents the {user_role}. 
-        Stay strictly within the facts of the case. 
-        Do not add headings like "Opening Statement".
-        '''
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", template)
-        ])
-
-        chain = prompt | get_llm() | StrOutputParser()
-
-        response = chain.invoke({
+        response = await _cached_ainvoke("opening", {
             'ai_role': ai_role,
             'case_details': case_details,
             'user_role': user_role
         })
-
-        response = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
         return response
     except Exception as e:
+        # Rate limits and provider hiccups go up to handle_rate_limit, which rests or rotates the key
+        if is_transient_error(e):
+            raise
         logger.error(f"Error generating opening statement: {str(e)}")
         return "I apologize, but I'm unable to generate an opening statement at this time. Please try again later."
 
 # ---- Closing Statement ----
-async def closing_statement(history: str, ai_role: str, user_role: str) -> str:
+async def closing_statement(history: List[Tuple[str, str]], ai_role: str, user_role: str) -> str:
     try:
-        # Truncate history if it's too long to avoid token limits
-        if len(history) > 15000:  # Approximate token limit safety
-            logger.info(f"History too long ({len(history)} chars), truncating for closing statement")
-            # Keep the beginning context and the most recent arguments
-            parts = history.split('\n\n')
-            if len(parts) > 6:
-                # Keep intro + last 5 argument blocks
-                truncated = parts[0] + '\n\n' + '\n\n'.join(parts[-5:])
-                history = truncated
-                logger.info(f"Truncated history to {len(history)} chars")
-
-        template = '''You are an Indian lawyer from the {ai_role}'s side. 
-        Provide a powerful closing statement (around 250 words) based on the full case history: {history}. 
-        Summarize your strongest points and highlight evidence. 
-        The opposing lawyer represents the {user_role}. 
-        End your statement with: "I rest my case here". 
-        Do not add headings like "Closing Statement".
-        '''
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", template)
-        ])
-
-        chain = prompt | get_llm() | StrOutputParser()
-
-        response = chain.invoke({
+        response = await _cached_ainvoke("closing", _prompt_variables("closing", {
             'ai_role': ai_role,
             'history': history,
             'user_role': user_role
-        })
-
-        response = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
+        }))
         
         # Verify we got a valid response
-        if not response or len(response) < 50 or "apologize" in response.lower():
+        if not _is_usable(response):
             logger.warning(f"Received potentially invalid closing statement: {response[:50]}...")
             raise ValueError("Invalid closing statement response")
             
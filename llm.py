@@ -1,15 +1,57 @@
+import asyncio
+import atexit
+import os
+from functools import lru_cache
+import httpx
+from langchain_community.cache import SQLiteCache
 from langchain_groq import ChatGroq
 from llm_manager import get_current_key, get_current_model
 
-# Function to get a fresh LLM instance with current model and key
-def get_llm():
-    # Get a new instance each time to ensure we use the latest model and key
+# Exact-match response cache on local disk: a repeated (model, prompt, params)
+# call is answered from SQLite instead of going back to Groq. Only LLMs built
+# with cached=True use it, so prompts meant to vary between calls (random
+# names) or retried after a rejected reply (lawyer arguments) still reach
+# the model
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".langchain.db")
+LLM_CACHE = SQLiteCache(database_path=LLM_CACHE_PATH)
+
+# One HTTP/2 connection pool per mode shared by every ChatGroq instance, so
+# calls reuse keep-alive connections (and multiplex concurrent requests over
+# them) instead of opening a new TLS session each time
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+_HTTP_CLIENT = httpx.Client(http2=True, limits=_HTTP_LIMITS, timeout=60)
+_HTTP_ASYNC_CLIENT = httpx.AsyncClient(http2=True, limits=_HTTP_LIMITS, timeout=60)
+
+@atexit.register
+def _close_http_clients():
+    _HTTP_CLIENT.close()
+    try:
+        asyncio.run(_HTTP_ASYNC_CLIENT.aclose())
+    except RuntimeError:
+        # Pooled connections belong to an event loop that is already closed
+        pass
+
+TEMPERATURE = 0.1
+
+# Function to build an LLM instance for an explicit model and key
+@lru_cache(maxsize=32)
+def build_llm(model, api_key, cached=False):
+    # Cached per (model, key): rotating either one yields a new instance, and
+    # rotating back reuses the old one. Bounded so long runs over many
+    # key/model pairs don't hold on to every client ever built
     return ChatGroq(
+        cache=LLM_CACHE if cached else False,
         streaming=True,
-        model=get_current_model(),
-        temperature=0.1,
-        api_key=get_current_key(),
-        max_tokens=2048
+        model=model,
+        temperature=TEMPERATURE,
+        api_key=api_key,
+        max_tokens=2048,
+        http_client=_HTTP_CLIENT,
+        http_async_client=_HTTP_ASYNC_CLIENT
     )
 
+# Function to get the LLM instance for the current model and key
+def get_llm():
+    return build_llm(get_current_model(), get_current_key())
+
 # Models tested: llama-3.3-70b-versatile (best), llama-3.1-8b-instant (good) deepseek-ai/DeepSeek-R1
\ No newline at end of file
@@ -0,0 +1,161 @@
+import hashlib
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+import numpy as np
+import orjson
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Width of the hashed embedding vectors
+EMBEDDING_DIM = 384
+
+def make_key(payload: dict) -> str:
+    """Stable SHA-256 key for a JSON-serialisable payload.
+
+    The digest doubles as the request's identifier in logs.
+    """
+    return hashlib.sha256(orjson.dumps(payload, default=str, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def embed(text: str) -> np.ndarray:
+    """Hashed bag-of-words embedding: L2-normalised term counts folded into EMBEDDING_DIM buckets."""
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for token in _TOKEN_RE.findall(text.lower()):
+        bucket = zlib.crc32(token.encode("utf-8"))
+        # The top hash bit picks the sign so bucket collisions tend to cancel out
+        vector[bucket % EMBEDDING_DIM] += 1.0 if bucket & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+def quantize(vector: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Symmetric int8 quantisation: (int8 vector, scale) with vector ≈ q * scale."""
+    peak = float(np.abs(vector).max())
+    if not peak:
+        return np.zeros(EMBEDDING_DIM, dtype=np.int8), 0.0
+    scale = peak / 127
+    return np.round(vector / scale).astype(np.int8), scale
+
+class _VectorIndex:
+    """Embeddings of one namespace stored as int8 rows of a single (N, D) matrix.
+
+    Each row keeps its own scale, so the index takes a quarter of the memory
+    of float32 rows at a small cost in score precision.
+    """
+
+    def __init__(self):
+        self.matrix = np.empty((16, EMBEDDING_DIM), dtype=np.int8)
+        self.scales = np.empty(16, dtype=np.float32)
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key: str, vector: np.ndarray):
+        size = len(self.keys)
+        if size == len(self.matrix):
+            # Grow geometrically so inserts stay amortised O(D)
+            grown = np.empty((2 * size, EMBEDDING_DIM), dtype=np.int8)
+            grown[:size] = self.matrix
+            self.matrix = grown
+            self.scales = np.resize(self.scales, 2 * size)
+        self.matrix[size], self.scales[size] = quantize(vector)
+        self.rows[key] = size
+        self.keys.append(key)
+
+    def remove(self, key: str):
+        # Move the last row into the freed slot
+        row = self.rows.pop(key)
+        last = len(self.keys) - 1
+        if row != last:
+            moved = self.keys[last]
+            self.matrix[row] = self.matrix[last]
+            self.scales[row] = self.scales[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+        self.keys.pop()
+
+    def best(self, query: np.ndarray) -> Tuple[str, float]:
+        """Key and approximate cosine score of the row closest to query."""
+        size = len(self.keys)
+        query_q, query_scale = quantize(query)
+        # Accumulate in int32: 127 * 127 * EMBEDDING_DIM cannot overflow it
+        dots = self.matrix[:size].astype(np.int32) @ query_q.astype(np.int32)
+        scores = dots * self.scales[:size] * query_scale
+        row = int(scores.argmax())
+        return self.keys[row], float(scores[row])
+
+class SemanticCache:
+    """In-process cache of LLM responses.
+
+    Lookups hit an exact-key dict first and fall back to cosine similarity
+    over embeddings of the prompt payload. Similarity matches are only made
+    within the same namespace, so callers can keep unrelated prompt kinds
+    apart. Entries expire after `ttl` seconds and the least recently used
+    entry is evicted once `max_entries` is exceeded.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 24 * 60 * 60, max_entries: int = 10_000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # key -> (stored_at, value, namespace)
+        self._entries: "OrderedDict[str, Tuple[float, str, Hashable]]" = OrderedDict()
+        self._vectors: Dict[Hashable, _VectorIndex] = {}
+
+    def _expired(self, stored_at: float) -> bool:
+        return time.monotonic() - stored_at > self.ttl
+
+    def _evict(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        index = self._vectors.get(entry[2])
+        if index is not None and key in index.rows:
+            index.remove(key)
+            if not len(index):
+                del self._vectors[entry[2]]
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry and self._expired(entry[0]):
+            self._evict(key)
+            return None
+        return entry
+
+    def get(self, key: str, text: Optional[str] = None, namespace: Hashable = None) -> Optional[str]:
+        """Return the cached response for `key`, or for a payload similar to `text`."""
+        found_key = key
+        entry = self._lookup(key)
+
+        if entry is None and text is not None and namespace in self._vectors:
+            best_key, best_score = self._vectors[namespace].best(embed(text))
+            if best_score >= self.threshold:
+                found_key = best_key
+                entry = self._lookup(best_key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(found_key)
+        return entry[1]
+
+    def set(self, key: str, value: str, text: Optional[str] = None, namespace: Hashable = None):
+        """Store `value` under `key`; index `text` for similarity lookups if given."""
+        if key in self._entries:
+            self._evict(key)
+        if text is not None:
+            if namespace not in self._vectors:
+                self._vectors[namespace] = _VectorIndex()
+            self._vectors[namespace].add(key, embed(text))
+        self._entries[key] = (time.monotonic(), value, namespace)
+
+        while len(self._entries) > self.max_entries:
+            self._evict(next(iter(self._entries)))
@@ -1,17 +1,50 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
 import os
-from itertools import cycle
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from functools import wraps
+from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows: state is still saved, just without file locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
 # Counters for tracking API keys and groq_models
 total_keys = 0
 total_models = 0
 rotation_count = 0
+_rotation_counter = itertools.count(1)
+
+@dataclass
+class KeyUsage:
+    """API key usage of one model."""
+    total_keys: int
+    keys_used: int = 0
+    rotations: int = 0
 
 # Dictionary to track API key usage per model
 model_key_usage = {}
 
+# Until when each model, and each key of a model, counts as exhausted, taken
+# from the rate-limit error's "try again in"; persisted so later runs and
+# other workers skip them only for as long as the limit lasts
+exhausted_models = {}
+exhausted_keys = {}  # model -> {key: exhausted until}
+
 # Load keys
 groq_api_keys = os.getenv("GROQ_API_KEYS", "").split(",")
 if groq_api_keys[0] == "":
@@ -19,7 +52,7 @@ if groq_api_keys[0] == "":
 else:
     groq_api_keys = [k.strip() for k in groq_api_keys if k.strip()]
     total_keys = len(groq_api_keys)
-    print(f"✅ [DEBUG] {total_keys} GROQ_API_KEYS found in .env file")
+    logger.debug("✅ %d GROQ_API_KEYS found in .env file", total_keys)
 
 if not groq_api_keys:
     raise ValueError("❌ No GROQ_API_KEYS found in .env file")
@@ -31,33 +64,61 @@ if groq_models[0] == "":
 else:
     groq_models = [m.strip() for m in groq_models if m.strip()]
     total_models = len(groq_models)
-    print(f"✅ [DEBUG] {total_models} GROQ_MODELS found in .env file: {groq_models}")
+    logger.debug("✅ %d GROQ_MODELS found in .env file: %s", total_models, groq_models)
 
 if not groq_models:
     groq_models = ["llama-3.1-8b-instant"]
     total_models = 1
 
-available_groq_keys = groq_api_keys.copy()
-available_groq_models = groq_models.copy()
-
-key_cycle = cycle(available_groq_keys)
-model_cycle = cycle(available_groq_models)
+# The head of each deque is the one in use; exhausting it is a popleft
+available_groq_keys = deque(groq_api_keys)
+available_groq_models = deque(groq_models)
 
-current_groq_key = next(key_cycle)
-current_groq_model = next(model_cycle)
-
-# Initialize counters
-keys_remaining = len(available_groq_keys)
-models_remaining = len(available_groq_models)
-rotation_count = 0
+current_groq_key = available_groq_keys[0]
+current_groq_model = available_groq_models[0]
 
 # Initialize model_key_usage dictionary
 for model in groq_models:
-    model_key_usage[model] = {
-        "total_keys": len(groq_api_keys),
-        "keys_used": 0,
-        "rotations": 0
-    }
+    model_key_usage[model] = KeyUsage(total_keys=len(groq_api_keys))
+
+def __getattr__(name):
+    # keys_remaining / models_remaining are derived, so they can't drift from the deques
+    if name == "keys_remaining":
+        return len(available_groq_keys)
+    if name == "models_remaining":
+        return len(available_groq_models)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Guards every mutation of the rotation state; re-entrant because
+# rotate_key falls through to rotate_model
+_state_lock = threading.RLock()
+
+def _synchronized(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _state_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+# Rotation state shared with other worker processes and later runs
+STATE_PATH = Path(os.getenv("LLM_ROTATION_STATE", ".llm_rotation.json"))
+STATE_TTL = 24 * 60 * 60  # Groq's daily limits reset; the longest any exhaustion lasts
+
+def _fingerprint(key):
+    """Short stable id for an API key; the key itself is never written to disk."""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+_keys_by_fingerprint = {_fingerprint(k): k for k in groq_api_keys}
+
+# Serialises rotations triggered by concurrent coroutines
+_rotation_lock = asyncio.Lock()
+
+def _discard(items, item):
+    """Remove item from a rotation deque; O(1) when it is the head, as it usually is."""
+    if items and items[0] == item:
+        items.popleft()
+    elif item in items:
+        items.remove(item)
 
 def get_current_key():
     return current_groq_key
@@ -68,88 +129,91 @@ def get_current_model():
 def get_all_models():
     return groq_models
 
+@_synchronized
 def set_current_model(model_name):
-    global current_groq_model, model_cycle
+    global current_groq_model
     if model_name not in groq_models:
         raise ValueError(f"Model '{model_name}' not found in available groq_models.")
     current_groq_model = model_name
-    # Reset the model_cycle to start from the newly set current_groq_model
-    # This is a simplified approach; a more robust solution might re-create the cycle
-    # to ensure all groq_models are still eventually rotated through if needed.
-    model_cycle = cycle([current_groq_model] + [m for m in available_groq_models if m != current_groq_model])
+    # Move the newly set model to the head so rotation continues from it
+    _discard(available_groq_models, current_groq_model)
+    available_groq_models.appendleft(current_groq_model)
+
+def get_rotation_count():
+    return rotation_count
 
+@_synchronized
 def get_rotation_stats():
     """Get statistics about API key and model rotation."""
     return {
         "total_keys": total_keys,
-        "keys_remaining": keys_remaining,
+        "keys_remaining": len(available_groq_keys),
         "total_models": total_models,
-        "models_remaining": models_remaining,
+        "models_remaining": len(available_groq_models),
         "rotation_count": rotation_count,
         "current_groq_model": current_groq_model,
         "current_key_prefix": current_groq_key[:8] if current_groq_key else None,
-        "model_key_usage": model_key_usage
+        "model_key_usage": {model: asdict(usage) for model, usage in model_key_usage.items()}
     }
 
 def print_rotation_status():
-    """Print the current rotation status for debugging."""
+    """Log the current rotation status for debugging."""
     stats = get_rotation_stats()
-    print(f"📊 [ROTATION STATUS] Rotation #{stats['rotation_count']}")
-    print(f"   - Current model: {stats['current_groq_model']} ({stats['models_remaining']}/{stats['total_models']} groq_models remaining)")
-    print(f"   - Current key: {stats['current_key_prefix']}... ({stats['keys_remaining']}/{stats['total_keys']} keys remaining)")
+    logger.info("📊 [ROTATION STATUS] Rotation #%d", stats['rotation_count'])
+    logger.info("   - Current model: %s (%d/%d groq_models remaining)", stats['current_groq_model'], stats['models_remaining'], stats['total_models'])
+    logger.info("   - Current key: %s... (%d/%d keys remaining)", stats['current_key_prefix'], stats['keys_remaining'], stats['total_keys'])
     
-    # Print model-specific key usage if available
+    # Log model-specific key usage if available
     if hasattr(rotate_key, 'model_keys'):
-        print("\n📊 [MODEL-SPECIFIC KEY AVAILABILITY]")
+        logger.info("📊 [MODEL-SPECIFIC KEY AVAILABILITY]")
         for model, keys in rotate_key.model_keys.items():
             is_current = model == current_groq_model
-            print(f"   - {model}{' (current)' if is_current else ''}: {len(keys)}/{total_keys} keys available")
+            logger.info("   - %s%s: %d/%d keys available", model, " (current)" if is_current else "", len(keys), total_keys)
     
     return stats
 
+@_synchronized
 def reset_rotation_counters():
     """Reset all rotation counters and restore all keys and groq_models."""
-    global available_groq_keys, available_groq_models, key_cycle, model_cycle, current_groq_key, current_groq_model, keys_remaining, models_remaining, rotation_count, model_key_usage
+    global available_groq_keys, available_groq_models, current_groq_key, current_groq_model, rotation_count, _rotation_counter
     
     # Reset available keys and groq_models
-    available_groq_keys = groq_api_keys.copy()
-    available_groq_models = groq_models.copy()
-    
-    # Reset cycles
-    key_cycle = cycle(available_groq_keys)
-    model_cycle = cycle(available_groq_models)
+    available_groq_keys = deque(groq_api_keys)
+    available_groq_models = deque(groq_models)
     
     # Reset current key and model
-    current_groq_key = next(key_cycle)
-    current_groq_model = next(model_cycle)
+    current_groq_key = available_groq_keys[0]
+    current_groq_model = available_groq_models[0]
     
     # Reset counters
-    keys_remaining = len(available_groq_keys)
-    models_remaining = len(available_groq_models)
     rotation_count = 0
+    _rotation_counter = itertools.count(1)
     
     # Reset model_key_usage
     for model in groq_models:
-        model_key_usage[model] = {
-            "total_keys": len(groq_api_keys),
-            "keys_used": 0,
-            "rotations": 0
-        }
+        model_key_usage[model] = KeyUsage(total_keys=len(groq_api_keys))
     
     # Reset the model_keys tracking in rotate_key function
     if hasattr(rotate_key, 'model_keys'):
         delattr(rotate_key, 'model_keys')
+    exhausted_models.clear()
+    exhausted_keys.clear()
     
-    print("🔄 [DEBUG] Rotation counters reset. All keys and groq_models restored.")
+    save_rotation_state(merge=False)
+    logger.info("🔄 Rotation counters reset. All keys and groq_models restored.")
     print_rotation_status()
     return True
 
-def rotate_key():
-    """Switch to next API key. If none left for this model, rotate model."""
-    global current_groq_key, available_groq_keys, key_cycle, keys_remaining, rotation_count, model_key_usage
+@_synchronized
+def rotate_key(exhausted=None, retry_after=STATE_TTL):
+    """Switch to next API key. If none left for this model, rotate model.
 
-    rotation_count += 1
-    exhausted = current_groq_key
+    The exhausted key is skipped by later runs for retry_after seconds.
+    """
+    global current_groq_key, available_groq_keys, rotation_count
+
+    rotation_count = next(_rotation_counter)
+    exhausted = exhausted or current_groq_key
     
     # Instead of removing the key globally, track it per model
     # Create a model-specific key list if it doesn't exist
@@ -158,52 +222,58 @@ def rotate_key():
     
     # Initialize model-specific key list if needed
     if current_groq_model not in rotate_key.model_keys:
-        rotate_key.model_keys[current_groq_model] = groq_api_keys.copy()
+        rotate_key.model_keys[current_groq_model] = deque(groq_api_keys)
     
     # Remove the exhausted key from this model's available keys
-    if exhausted in rotate_key.model_keys[current_groq_model]:
-        rotate_key.model_keys[current_groq_model] = [k for k in rotate_key.model_keys[current_groq_model] if k != exhausted]
+    _discard(rotate_key.model_keys[current_groq_model], exhausted)
+    exhausted_keys.setdefault(current_groq_model, {})[exhausted] = time.time() + retry_after
     
     # Update the global available_groq_keys to be the current model's available keys
     available_groq_keys = rotate_key.model_keys[current_groq_model]
     keys_remaining = len(available_groq_keys)
     
     # Update model_key_usage
-    model_key_usage[current_groq_model]["keys_used"] += 1
-    model_key_usage[current_groq_model]["rotations"] += 1
+    model_key_usage[current_groq_model].keys_used += 1
+    model_key_usage[current_groq_model].rotations += 1
 
     if not available_groq_keys:
-        print(f"⚠️ [DEBUG] All API keys exhausted for model {current_groq_model}. Rotating to next model.")
-        print(f"📊 [STATS] Rotation #{rotation_count}: No keys left for {current_groq_model}, switching groq_models")
-        return rotate_model()
+        logger.warning("⚠️ All API keys exhausted for model %s. Rotating to next model.", current_groq_model)
+        logger.debug("📊 [STATS] Rotation #%d: No keys left for %s, switching groq_models", rotation_count, current_groq_model)
+        # The model is usable again as soon as its first key is
+        return rotate_model(max(0, min(exhausted_keys[current_groq_model].values()) - time.time()))
 
-    key_cycle = cycle(available_groq_keys)
-    current_groq_key = next(key_cycle)
+    current_groq_key = available_groq_keys[0]
+    save_rotation_state()
 
-    print(f"🔑 [DEBUG] API key switched for model {current_groq_model}: {exhausted[:8]}... ➝ {current_groq_key[:8]}... ({keys_remaining}/{total_keys} keys remaining)")
-    print(f"📊 [STATS] Rotation #{rotation_count}: {keys_remaining}/{total_keys} keys and {models_remaining}/{total_models} groq_models available")
+    logger.debug("🔑 API key switched for model %s: %s... ➝ %s... (%d/%d keys remaining)", current_groq_model, exhausted[:8], current_groq_key[:8], keys_remaining, total_keys)
+    logger.debug("📊 [STATS] Rotation #%d: %d/%d keys and %d/%d groq_models available", rotation_count, keys_remaining, total_keys, len(available_groq_models), total_models)
     return current_groq_key
 
 
-def rotate_model():
-    """Switch to next model and reset API keys."""
-    global current_groq_model, available_groq_models, model_cycle, available_groq_keys, key_cycle, current_groq_key, models_remaining, keys_remaining, rotation_count, model_key_usage
+@_synchronized
+def rotate_model(retry_after=STATE_TTL):
+    """Switch to next model and reset API keys.
+
+    The exhausted model is skipped by later runs for retry_after seconds.
+    """
+    global current_groq_model, available_groq_models, available_groq_keys, current_groq_key, rotation_count
 
-    rotation_count += 1
+    rotation_count = next(_rotation_counter)
     exhausted = current_groq_model
-    available_groq_models = [m for m in available_groq_models if m != exhausted]
+    _discard(available_groq_models, exhausted)
+    exhausted_models[exhausted] = time.time() + retry_after
     models_remaining = len(available_groq_models)
     
     # Update model_key_usage for the exhausted model
-    model_key_usage[exhausted]["keys_used"] = total_keys  # All keys used for this model
+    model_key_usage[exhausted].keys_used = total_keys  # All keys used for this model
 
     if not available_groq_models:
-        print(f"❌ [CRITICAL] All groq_models exhausted: {groq_models}")
-        print(f"📊 [STATS] Final rotation #{rotation_count}: All {total_models} groq_models exhausted after trying all {total_keys} keys")
+        save_rotation_state()
+        logger.critical("❌ All groq_models exhausted: %s", groq_models)
+        logger.debug("📊 [STATS] Final rotation #%d: All %d groq_models exhausted after trying all %d keys", rotation_count, total_models, total_keys)
         raise RuntimeError(f"❌ All groq_models exhausted: {groq_models}")
 
-    model_cycle = cycle(available_groq_models)
-    current_groq_model = next(model_cycle)
+    current_groq_model = available_groq_models[0]
 
     # Check if we've already used this model before
     if hasattr(rotate_key, 'model_keys') and current_groq_model in rotate_key.model_keys:
@@ -211,15 +281,273 @@ def rotate_model():
         available_groq_keys = rotate_key.model_keys[current_groq_model]
     else:
         # Reset API keys for new model
-        available_groq_keys = groq_api_keys.copy()
+        available_groq_keys = deque(groq_api_keys)
         # Initialize in the model_keys dictionary if it exists
         if hasattr(rotate_key, 'model_keys'):
-            rotate_key.model_keys[current_groq_model] = groq_api_keys.copy()
+            rotate_key.model_keys[current_groq_model] = available_groq_keys
     
     keys_remaining = len(available_groq_keys)
-    key_cycle = cycle(available_groq_keys)
-    current_groq_key = next(key_cycle)
+    current_groq_key = available_groq_keys[0]
+    save_rotation_state()
 
-    print(f"🔄 [DEBUG] Model switched: {exhausted} ➝ {current_groq_model} with {keys_remaining} fresh API keys")
-    print(f"📊 [STATS] Rotation #{rotation_count}: Switched to model {current_groq_model}, reset to {keys_remaining}/{total_keys} keys, {models_remaining}/{total_models} groq_models remaining")
+    logger.debug("🔄 Model switched: %s ➝ %s with %d fresh API keys", exhausted, current_groq_model, keys_remaining)
+    logger.debug("📊 [STATS] Rotation #%d: Switched to model %s, reset to %d/%d keys, %d/%d groq_models remaining", rotation_count, current_groq_model, keys_remaining, total_keys, models_remaining, total_models)
     return current_groq_model
+
+# ---- Rotation State Persistence ----
+@contextmanager
+def _locked(file, exclusive):
+    if fcntl:
+        fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+        yield file
+    finally:
+        if fcntl:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+def _read_state(file):
+    """Parse a state file, returning None if it is empty or corrupt."""
+    file.seek(0)
+    try:
+        return json.load(file)
+    except ValueError:
+        return None
+
+def _live(entries, now):
+    """Exhaustion entries that have not expired yet."""
+    return {name: until for name, until in entries.items() if until > now}
+
+@_synchronized
+def save_rotation_state(merge=True):
+    """Write the rotation state to STATE_PATH.
+
+    Exhausted models and keys are stored with the time their limit lifts
+    and expire one by one. With merge, entries another worker
+    already wrote to the file are kept, so concurrent workers don't hand
+    each other dead keys.
+    """
+    now = time.time()
+    state = {
+        "saved_at": now,
+        "rotation_count": rotation_count,
+        "current_model": current_groq_model,
+        "current_key": _fingerprint(current_groq_key),
+        "exhausted_models": _live(exhausted_models, now),
+        "exhausted_keys": {
+            model: _live({_fingerprint(k): until for k, until in keys.items()}, now)
+            for model, keys in exhausted_keys.items()
+        },
+        "model_key_usage": {model: asdict(usage) for model, usage in model_key_usage.items()},
+    }
+    try:
+        with open(STATE_PATH, "a+", encoding="utf-8") as file, _locked(file, exclusive=True):
+            previous = _read_state(file)
+            if merge and previous:
+                for model, until in _live(previous.get("exhausted_models", {}), now).items():
+                    state["exhausted_models"][model] = max(until, state["exhausted_models"].get(model, 0))
+                for model, entries in previous.get("exhausted_keys", {}).items():
+                    keys = state["exhausted_keys"].setdefault(model, {})
+                    for fp, until in _live(entries, now).items():
+                        keys[fp] = max(until, keys.get(fp, 0))
+            file.seek(0)
+            file.truncate()
+            json.dump(state, file)
+    except OSError as e:
+        logger.warning("⚠️ Could not save rotation state to %s: %s", STATE_PATH, e)
+
+@_synchronized
+def load_rotation_state():
+    """Resume rotation from the state saved by an earlier run or another worker."""
+    global available_groq_keys, available_groq_models, current_groq_key, current_groq_model, rotation_count, _rotation_counter
+
+    if not STATE_PATH.exists():
+        return False
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as file, _locked(file, exclusive=False):
+            state = _read_state(file)
+    except OSError:
+        return False
+    if not state:
+        return False
+
+    now = time.time()
+    # No entry outlives saved_at by more than STATE_TTL, so a stale file has nothing left to resume
+    if now - state.get("saved_at", 0) > STATE_TTL:
+        return False
+    dead_models = _live(state.get("exhausted_models", {}), now)
+    models = deque(m for m in groq_models if m not in dead_models)
+    dead_keys = {
+        model: {
+            _keys_by_fingerprint[fp]: until
+            for fp, until in _live(entries, now).items() if fp in _keys_by_fingerprint
+        }
+        for model, entries in state.get("exhausted_keys", {}).items() if model in groq_models
+    }
+    model_keys = {
+        model: deque(k for k in groq_api_keys if k not in keys)
+        for model, keys in dead_keys.items() if keys
+    }
+    if not models or not model_keys.get(models[0], True):
+        return False
+
+    # Put the saved current model and key back at the head of their deques
+    if state["current_model"] in models:
+        models.rotate(-models.index(state["current_model"]))
+    keys = model_keys.get(models[0]) or deque(groq_api_keys)
+    current_key = _keys_by_fingerprint.get(state["current_key"])
+    if current_key in keys:
+        keys.rotate(-keys.index(current_key))
+
+    if model_keys:
+        rotate_key.model_keys = model_keys
+    exhausted_models.update(dead_models)
+    for model, keys_until in dead_keys.items():
+        exhausted_keys.setdefault(model, {}).update(keys_until)
+    available_groq_models = models
+    available_groq_keys = keys
+    current_groq_model = models[0]
+    current_groq_key = keys[0]
+    rotation_count = state.get("rotation_count", 0)
+    _rotation_counter = itertools.count(rotation_count + 1)
+    for model, usage in state.get("model_key_usage", {}).items():
+        if model in model_key_usage:
+            model_key_usage[model] = KeyUsage(**usage)
+
+    logger.info("♻️ Resumed rotation state from %s: model %s, %d/%d keys, %d/%d groq_models", STATE_PATH, current_groq_model, len(available_groq_keys), total_keys, len(available_groq_models), total_models)
+    return True
+
+async def rotate_key_async(seen_rotation=None, exhausted=None, retry_after=STATE_TTL):
+    """rotate_key for concurrent callers.
+
+    seen_rotation is the rotation count the caller observed before its LLM
+    call; if another coroutine has rotated since then, the rotation is
+    skipped so one burst of 429s doesn't burn several keys.
+    """
+    async with _rotation_lock:
+        if seen_rotation is not None and rotation_count != seen_rotation:
+            return current_groq_key
+        return rotate_key(exhausted, retry_after)
+
+async def rotate_model_async(seen_rotation=None, retry_after=STATE_TTL):
+    """rotate_model for concurrent callers; see rotate_key_async."""
+    async with _rotation_lock:
+        if seen_rotation is not None and rotation_count != seen_rotation:
+            return current_groq_model
+        return rotate_model(retry_after)
+
+# Per-key limits of one model; defaults are Groq's free tier
+REQUESTS_PER_MINUTE = float(os.getenv("GROQ_RPM", "30"))
+TOKENS_PER_MINUTE = float(os.getenv("GROQ_TPM", "12000"))
+
+class TokenBucket:
+    """Requests-per-minute and tokens-per-minute budget of one key and model.
+
+    Both budgets refill continuously. acquire() waits until a request of the
+    given size fits, so calls are spaced out before the provider rejects them;
+    shrink() lowers both rates after a rate limit slipped through anyway.
+    """
+
+    def __init__(self, rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens=0):
+        # A prompt larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self.requests) * 60 / self.rpm,
+                    (tokens - self.tokens) * 60 / self.tpm
+                ))
+
+    def shrink(self, factor=0.9):
+        self.rpm = max(1.0, self.rpm * factor)
+        self.tpm = max(1.0, self.tpm * factor)
+
+# Errors worth retrying: rate limits, provider overload and network hiccups
+_TRANSIENT_RE = re.compile(r"rate limit|\b429\b|\b503\b|over capacity|timed? ?out|connection", re.IGNORECASE)
+
+def is_transient_error(error) -> bool:
+    return bool(_TRANSIENT_RE.search(str(error)))
+
+# "Please try again in 1m2.5s" / "in 7.66s" in Groq rate-limit errors
+_RETRY_AFTER_RE = re.compile(r"try again in (?:(\d+)m)?([\d.]+)s")
+
+def retry_after_seconds(error_text: str, default: float = 60) -> float:
+    """Cooldown suggested by a rate-limit error, or default if it gives none."""
+    match = _RETRY_AFTER_RE.search(error_text)
+    if not match:
+        return default
+    return int(match.group(1) or 0) * 60 + float(match.group(2))
+
+class KeyScheduler:
+    """Spreads calls over the current model's keys.
+
+    acquire() returns the least recently used key that is not cooling down
+    after a rate limit, waiting for the earliest cooldown to end when every
+    key is cooling, and then for that key's TokenBucket to admit the call.
+    Callers hand errors back through report_error() together with the key
+    they used.
+    """
+
+    def __init__(self):
+        self.last_used = {}
+        self.cooldown_until = {}
+        self.buckets = {}
+
+    def bucket(self, key):
+        """Token bucket of key for the current model."""
+        pair = (key, current_groq_model)
+        if pair not in self.buckets:
+            self.buckets[pair] = TokenBucket()
+        return self.buckets[pair]
+
+    async def acquire(self, tokens=0):
+        while True:
+            now = time.monotonic()
+            keys = available_groq_keys
+            if not keys:
+                return current_groq_key
+
+            healthy = [k for k in keys if self.cooldown_until.get(k, 0) <= now]
+            if healthy:
+                key = min(healthy, key=lambda k: self.last_used.get(k, 0))
+                self.last_used[key] = now
+                await self.bucket(key).acquire(tokens)
+                return key
+
+            await asyncio.sleep(min(self.cooldown_until[k] for k in keys) - now)
+
+    def mark_rate_limited(self, key, retry_after):
+        self.cooldown_until[key] = time.monotonic() + retry_after
+        self.bucket(key).shrink()
+
+    def report_error(self, key, error):
+        """Tag error with the key that raised it and rest the key after a short-term rate limit.
+
+        Handlers further up read the key from error.groq_key.
+        """
+        error.groq_key = key
+        error_str = str(error).lower()
+        if "rate limit" in error_str and "tokens per day" not in error_str:
+            self.mark_rate_limited(key, retry_after_seconds(str(error)))
+
+key_scheduler = KeyScheduler()
+
+load_rotation_state()
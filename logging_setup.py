@@ -0,0 +1,30 @@
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+_listener = None
+
+def setup_logging(level: str = None, fmt: str = "%(message)s"):
+    """Route all logging through a queue drained by a background thread.
+
+    Callers only enqueue records, so formatting and stdout writes never block
+    the event loop. The level comes from LOG_LEVEL (default INFO) unless given.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(fmt))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(log_queue)]
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Flush whatever is still queued on exit
+    atexit.register(_listener.stop)
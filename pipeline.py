@@ -1,28 +1,49 @@
 # pipeline.py
 import asyncio
-import time
-import json
+import logging
 import os
-from pymongo import MongoClient, errors
+import random
+import re
+from itertools import zip_longest
+from pymongo import errors
+from pymongo.operations import UpdateOne
 from bson import ObjectId
-from dotenv import load_dotenv
-from llm_manager import rotate_key, rotate_model, print_rotation_status
+import orjson
+from llm_manager import STATE_TTL, rotate_key_async, rotate_model_async, print_rotation_status, get_rotation_count, retry_after_seconds
 from case_generation import generate_case
-from lawyer import opening_statement, generate_counter_argument, closing_statement
+from lawyer import opening_statement, generate_counter_argument, closing_statement, cache_stats, is_valid_response, run_pool
+from db_client import get_db
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
 
-# ---- Load Environment Variables ----
-load_dotenv()
-MONGODB_URL = os.getenv("MONGODB_URL")  # Cloud MongoDB URL from .env
-DB_NAME = "ai_courtroom"
 COLLECTION_NAME = "cases"
 
-client = MongoClient(MONGODB_URL)
-db = client[DB_NAME]
+# Log the full rotation table before every rate-limit rotation (noisy under load)
+LOG_ROTATION_VERBOSE = os.getenv("LOG_ROTATION_VERBOSE", "0") == "1"
+
+# Cases whose arguments are generated at the same time
+CASE_CONCURRENCY = int(os.getenv("CASE_CONCURRENCY", "8"))
+case_semaphore = asyncio.Semaphore(CASE_CONCURRENCY)
+
+# Sections worked on at the same time
+SECTION_CONCURRENCY = int(os.getenv("SECTION_CONCURRENCY", "4"))
+
+db = get_db()
 cases_collection = db[COLLECTION_NAME]
 
+def ensure_indexes():
+    """Index the fields the pipeline filters on; a no-op when they already exist."""
+    cases_collection.create_index([("section", 1), ("status", 1)])
+    try:
+        cases_collection.create_index("cnr", unique=True)
+    except errors.OperationFailure as e:
+        # Existing duplicate CNRs block the unique index; the pipeline still works without it
+        print(f"⚠️ Could not create unique index on cnr: {e}")
+
 # Load IPC sections from JSON file
-with open("top_80_ipc_sections.json", "r") as f:
-    ipc_data = json.load(f)
+with open("top_80_ipc_sections.json", "rb") as f:
+    ipc_data = orjson.loads(f.read())
     ipc_sections = [entry["Section"] for entry in ipc_data]
 
 # ---- Rotation Status Tracking ----
@@ -47,8 +68,8 @@ def print_final_rotation_status(initial_stats):
     print(f"   - Total rotations: {rotation_count}")
     print(f"   - API keys used: {keys_used} out of {initial_stats['total_keys']}")
     print(f"   - Models used: {models_used} out of {initial_stats['total_models']}")
-    print(f"   - Starting model: {initial_stats['current_model']}")
-    print(f"   - Ending model: {final_stats['current_model']}")
+    print(f"   - Starting model: {initial_stats['current_groq_model']}")
+    print(f"   - Ending model: {final_stats['current_groq_model']}")
     
     # Print model-specific usage
     print(f"\n📊 [MODEL-SPECIFIC KEY USAGE]")
@@ -57,74 +78,199 @@ def print_final_rotation_status(initial_stats):
         total_keys_for_model = usage['total_keys']
         rotations_for_model = usage['rotations']
         print(f"   - {model}: {keys_used_for_model}/{total_keys_for_model} keys used ({rotations_for_model} rotations)")
+
+    # Print response cache effectiveness
+    stats = cache_stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups * 100 if lookups else 0.0
+    print(f"\n📊 [RESPONSE CACHE]")
+    print(f"   - Hits: {stats['hits']}, misses: {stats['misses']} ({hit_rate:.1f}% hit rate)")
     
     return final_stats
 
 # ---- Retry Decorator ----
+def jittered(delay: float) -> float:
+    """Stretch a delay by up to 25% so concurrent retries don't all fire at once."""
+    return delay * (1 + random.random() * 0.25)
+
+# Groq errors look like "Error code: 429 - {...}"; the body after the status is JSON
+_ERROR_JSON_RE = re.compile(r"Error code:[^{]*(\{.*\})\s*$", re.DOTALL)
+
 def handle_rate_limit(func):
     async def wrapper(*args, **kwargs):
+        seen_rotation = get_rotation_count()
         try:
             return await func(*args, **kwargs)
         except Exception as e:
             error_text = str(e)
             error_str = error_text.lower()
 
-            # Try to parse JSON to check error type
+            # Parse the JSON body, if the error carries one, to check the error type
+            match = _ERROR_JSON_RE.search(error_text)
             try:
-                error_json = json.loads(error_text.split("Error code:")[-1].strip())
-            except Exception:
+                error_json = orjson.loads(match.group(1)) if match else {}
+            except orjson.JSONDecodeError:
+                error_json = {}
+            if not isinstance(error_json, dict):
                 error_json = {}
 
             if "rate limit" in error_str:
+                # How long the limited key or model stays skipped, here and in later runs
+                daily_retry_after = retry_after_seconds(error_text, default=STATE_TTL)
                 # Check for daily token exhaustion
-                if "tokens per day" in error_str or error_json.get("error", {}).get("code") == "rate_limit_exceeded":
-                    # For any TPD (tokens per day) error, always rotate model
-                    print(f"⚠️ [DEBUG] Daily token limit reached. Rotating model...")
-                    print_rotation_status()  # Print current status before rotation
-                    rotate_model()
-                    await asyncio.sleep(20)  # Wait for 20 seconds after model rotation
+                if "tokens per day" in error_str and getattr(e, "groq_key", None):
+                    # Daily limits are per key: drop the key that was actually limited
+                    # for this model (not whichever is current now); rotate_key moves
+                    # on to the next model once the model has no keys left
+                    logger.debug("⚠️ Daily token limit reached on key %s... Discarding it.", e.groq_key[:8])
+                    await rotate_key_async(exhausted=e.groq_key, retry_after=daily_retry_after)  # A specific key, so never skipped as already rotated
+                elif "tokens per day" in error_str or error_json.get("error", {}).get("code") == "rate_limit_exceeded":
+                    # For any other TPD (tokens per day) error, always rotate model
+                    logger.debug("⚠️ Daily token limit reached. Rotating model...")
+                    if LOG_ROTATION_VERBOSE:
+                        print_rotation_status()  # Print current status before rotation
+                    await rotate_model_async(seen_rotation, retry_after=daily_retry_after)
+                    await asyncio.sleep(jittered(20))  # Wait ~20 seconds after model rotation
+                elif getattr(e, "groq_key", None):
+                    # Short-term limits clear by themselves: the call that hit it already
+                    # rested its key, so the scheduler hands the other keys to the retry
+                    logger.debug("⚠️ Short-term rate limit hit. Cooling key %s...", e.groq_key[:8])
                 else:
-                    print(f"⚠️ [DEBUG] Short-term rate limit hit. Rotating key...")
-                    print_rotation_status()  # Print current status before rotation
-                    rotate_key()
-                    await asyncio.sleep(10)  # Wait for 10 seconds after key rotation
+                    logger.debug("⚠️ Short-term rate limit hit. Rotating key...")
+                    if LOG_ROTATION_VERBOSE:
+                        print_rotation_status()  # Print current status before rotation
+                    # A per-minute limit only sidelines the key until it lifts
+                    await rotate_key_async(seen_rotation, retry_after=retry_after_seconds(error_text))
+                    await asyncio.sleep(jittered(10))  # Wait ~10 seconds after key rotation
                 return None  # Signal that rate limit was hit and no retry
 
             elif "503" in error_str or "over capacity" in error_str:
-                print(f"❌ [DEBUG] 503 error or over capacity. Not retrying.")
+                logger.debug("❌ 503 error or over capacity. Not retrying.")
                 raise e # Re-raise immediately, no retries
 
             else:
-                print(f"❌ [DEBUG] Other error: {e}. Not retrying.")
+                logger.debug("❌ Other error: %s. Not retrying.", e)
                 raise e # Re-raise immediately, no retries
     return wrapper
 
-def is_valid_response(text: str) -> bool:
-    """Check if LLM output is a real argument, not a fallback message."""
-    if not text:
-        return False
-    fallback_patterns = [
-        "i apologize",
-        "unable to",
-        "please try again later",
-        "failed after multiple retries"
-    ]
-    return not any(p in text.lower() for p in fallback_patterns)
+# Unsaved changes per case, written together by flush_progress: arguments to
+# append ("push", as field -> (index of the first one, arguments)) and fields
+# to overwrite ("set")
+pending_ops = {}
+flush_lock = asyncio.Lock()
+FLUSH_INTERVAL = 5.0  # Seconds between background flushes
+
+def _object_id(case_id):
+    # Ids read from or inserted into Mongo are already ObjectIds
+    return case_id if isinstance(case_id, ObjectId) else ObjectId(case_id)
+
+def _queue_update(oid, push=None, set_fields=None):
+    """Fold an update into the case's pending one, keeping arguments in order."""
+    entry = pending_ops.setdefault(oid, {"push": {}, "set": {}})
+    for field, (start, args) in (push or {}).items():
+        if field in entry["set"]:
+            entry["set"][field] = entry["set"][field] + args
+        elif field in entry["push"]:
+            entry["push"][field][1].extend(args)
+        else:
+            entry["push"][field] = (start, list(args))
+    for field, value in (set_fields or {}).items():
+        # A full array supersedes appends still queued for it
+        entry["push"].pop(field, None)
+        entry["set"][field] = value
+
+def save_append(case_id, side, arg, index):
+    """Queue a new argument for `side` ("plaintiff" or "defendant") of a case, at position `index`."""
+    _queue_update(_object_id(case_id), push={f"{side}_arguments": (index, [arg])}, set_fields={"status": "in-progress"})
 
 def save_progress(case_id, plaintiff_args, defendant_args, status="in-progress"):
-    """Incrementally update MongoDB with latest arguments."""
-    try:
-        cases_collection.update_one(
-            {"_id": ObjectId(case_id)},
-            {"$set": {
-                "plaintiff_arguments": plaintiff_args,
-                "defendant_arguments": defendant_args,
-                "status": status
-            }}
-        )
-        print(f"💾 Progress saved for case {case_id} (Status: {status})")
-    except errors.PyMongoError as e:
-        print(f"❌ MongoDB Update Error: {e}")
+    """Queue the full argument arrays and status of a case, replacing any queued appends."""
+    _queue_update(_object_id(case_id), set_fields={
+        "plaintiff_arguments": list(plaintiff_args),
+        "defendant_arguments": list(defendant_args),
+        "status": status
+    })
+
+def _requeue(batch):
+    """Put failed updates back ahead of anything queued since they were taken."""
+    for oid, entry in batch:
+        newer = pending_ops.pop(oid, None)
+        _queue_update(oid, entry["push"], entry["set"])
+        if newer:
+            _queue_update(oid, newer["push"], newer["set"])
+
+def _update_filter(oid, entry):
+    """Match the case only while none of the queued appends is stored yet.
+
+    An update whose bulk_write failed may still have been applied, so a
+    retried $push must not add the same arguments a second time.
+    """
+    update_filter = {"_id": oid}
+    for field, (start, _) in entry["push"].items():
+        update_filter[f"{field}.{start}"] = {"$exists": False}
+    return update_filter
+
+def _update_document(entry):
+    update = {}
+    if entry["push"]:
+        update["$push"] = {field: {"$each": args} for field, (_, args) in entry["push"].items()}
+    if entry["set"]:
+        update["$set"] = entry["set"]
+    return update
+
+async def flush_progress():
+    """Write every queued case update to MongoDB in one bulk_write."""
+    async with flush_lock:
+        if not pending_ops:
+            return
+        batch = list(pending_ops.items())
+        pending_ops.clear()
+        ops = [UpdateOne(_update_filter(oid, entry), _update_document(entry)) for oid, entry in batch]
+        try:
+            result = await asyncio.to_thread(cases_collection.bulk_write, ops, ordered=False)
+            print(f"💾 Progress saved for {len(ops)} case(s)")
+            if result.matched_count < len(ops):
+                # An append guard found its position already filled: the stored
+                # arguments differ from this run's, so those updates were dropped
+                print(f"⚠️ {len(ops) - result.matched_count} of {len(ops)} case update(s) matched nothing; "
+                      f"their arguments were already stored by an earlier write")
+        except errors.BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            _requeue(batch[index] for index in sorted(failed))
+            print(f"❌ MongoDB Update Error for {len(failed)} of {len(ops)} case(s): {e}")
+        except errors.PyMongoError as e:
+            # Appends must not be lost or reordered, so retry them on the next flush
+            _requeue(batch)
+            print(f"❌ MongoDB Update Error: {e}")
+
+async def periodic_flush(interval: float = FLUSH_INTERVAL):
+    """Flush queued progress every `interval` seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        await flush_progress()
+
+async def generate_together(case_id, requests):
+    """Run independent argument generations concurrently and queue the valid ones.
+
+    `requests` holds (side, args list, coroutine) triples. Returns the sides
+    whose response was missing or a fallback message. When a call raised, the
+    other side's valid response is still kept and the error is re-raised for
+    handle_rate_limit.
+    """
+    results = await asyncio.gather(*(coro for _, _, coro in requests), return_exceptions=True)
+    failed = []
+    error = None
+    for (side, args, _), resp in zip(requests, results):
+        if isinstance(resp, BaseException):
+            error = error or resp
+        elif resp and is_valid_response(resp):
+            args.append(resp)
+            save_append(case_id, side.lower(), resp, len(args) - 1)
+            continue
+        failed.append(side)
+    if error is not None:
+        raise error
+    return failed
 
 # ---- Generate / Complete Arguments for Case ----
 @handle_rate_limit
@@ -136,37 +282,36 @@ async def generate_arguments_for_case(case: dict):
     print(f"\n=== Working on case: {case_title} (ID: {case_id}) ===")
 
     # Resume if already has some arguments
-    plaintiff_args = case.get("plaintiff_arguments", [])
-    defendant_args = case.get("defendant_arguments", [])
+    # Kept on the case, so a retry resumes from what the last attempt queued
+    plaintiff_args = case.setdefault("plaintiff_arguments", [])
+    defendant_args = case.setdefault("defendant_arguments", [])
 
-    # Step 1: Opening Statements
+    # Step 1: Opening Statements (each depends only on the case, so both run at once)
+    openings = []
     if len(plaintiff_args) == 0:
         print("🟢 Generating Plaintiff Opening...")
-        resp = await opening_statement("Plaintiff", case_details, "Defendant")
-        if resp and is_valid_response(resp):
-            plaintiff_args.append(resp)
-            save_progress(case_id, plaintiff_args, defendant_args)
-        else:
-            print("⚠️ Failed to generate valid plaintiff opening statement. Skipping case.")
-            return None  # Signal to skip this case
-
+        openings.append(("Plaintiff", plaintiff_args, opening_statement("Plaintiff", case_details, "Defendant")))
     if len(defendant_args) == 0:
         print("🟢 Generating Defendant Opening...")
-        resp = await opening_statement("Defendant", case_details, "Plaintiff")
-        if resp and is_valid_response(resp):
-            defendant_args.append(resp)
-            save_progress(case_id, plaintiff_args, defendant_args)
-        else:
-            print("⚠️ Failed to generate valid defendant opening statement. Skipping case.")
-            return None  # Signal to skip this case
+        openings.append(("Defendant", defendant_args, opening_statement("Defendant", case_details, "Plaintiff")))
+
+    for side in await generate_together(case_id, openings):
+        print(f"⚠️ Failed to generate valid {side.lower()} opening statement. Skipping case.")
+        return None  # Signal to skip this case
 
     # Step 2: Arguments (2 rounds)
-    history = plaintiff_args + defendant_args
+    # History as (speaker, argument) turns in courtroom order
+    history = [
+        (speaker, arg)
+        for p_arg, d_arg in zip_longest(plaintiff_args, defendant_args)
+        for speaker, arg in (("Plaintiff", p_arg), ("Defendant", d_arg))
+        if arg is not None
+    ]
     while len(plaintiff_args) < 3:  # opening + 2 args
         round_num = len(plaintiff_args)
         print(f"\n🔷 Plaintiff Argument {round_num}")
         arg_p = await generate_counter_argument(
-            "\n".join(history),
+            history,
             f"Plaintiff, present your round {round_num} argument",
             "Plaintiff",
             "Defendant",
@@ -174,15 +319,15 @@ async def generate_arguments_for_case(case: dict):
         )
         if arg_p and is_valid_response(arg_p):
             plaintiff_args.append(arg_p)
-            history.append(arg_p)
-            save_progress(case_id, plaintiff_args, defendant_args)
+            history.append(("Plaintiff", arg_p))
+            save_append(case_id, "plaintiff", arg_p, len(plaintiff_args) - 1)
         else:
             print(f"⚠️ Failed to generate valid plaintiff argument {round_num}. Skipping case.")
             return None  # Signal to skip this case
 
         print(f"🔶 Defendant Counter {round_num}")
         arg_d = await generate_counter_argument(
-            "\n".join(history),
+            history,
             arg_p,
             "Defendant",
             "Plaintiff",
@@ -190,34 +335,24 @@ async def generate_arguments_for_case(case: dict):
         )
         if arg_d and is_valid_response(arg_d):
             defendant_args.append(arg_d)
-            history.append(arg_d)
-            save_progress(case_id, plaintiff_args, defendant_args)
+            history.append(("Defendant", arg_d))
+            save_append(case_id, "defendant", arg_d, len(defendant_args) - 1)
         else:
             print(f"⚠️ Failed to generate valid defendant counter {round_num}. Skipping case.")
             return None  # Signal to skip this case
 
-    # Step 3: Closings
+    # Step 3: Closings (both answer the same completed history, so both run at once)
+    closings = []
     if len(plaintiff_args) < 4:
         print("\n🟢 Generating Plaintiff Closing...")
-        resp = await closing_statement("\n".join(history), "Plaintiff", "Defendant")
-        if resp and is_valid_response(resp):
-            plaintiff_args.append(resp)
-            history.append(resp)
-            save_progress(case_id, plaintiff_args, defendant_args)
-        else:
-            print("⚠️ Failed to generate valid plaintiff closing statement. Will retry.")
-            return False  # Signal retry needed
-
+        closings.append(("Plaintiff", plaintiff_args, closing_statement(history, "Plaintiff", "Defendant")))
     if len(defendant_args) < 4:
         print("🟢 Generating Defendant Closing...")
-        resp = await closing_statement("\n".join(history), "Defendant", "Plaintiff")
-        if resp and is_valid_response(resp):
-            defendant_args.append(resp)
-            history.append(resp)
-            save_progress(case_id, plaintiff_args, defendant_args)
-        else:
-            print("⚠️ Failed to generate valid defendant closing statement. Will retry.")
-            return False  # Signal retry needed
+        closings.append(("Defendant", defendant_args, closing_statement(history, "Defendant", "Plaintiff")))
+
+    for side in await generate_together(case_id, closings):
+        print(f"⚠️ Failed to generate valid {side.lower()} closing statement. Will retry.")
+        return False  # Signal retry needed
 
     # Step 4: Mark resolved only if both sides have 4 entries
     if len(plaintiff_args) == 4 and len(defendant_args) == 4:
@@ -228,9 +363,10 @@ async def generate_arguments_for_case(case: dict):
         print(f"⚠️ Case {case_id} incomplete. Will retry missing arguments next run.")
         return False  # Signal retry needed
 
-# ---- Generate a New Case ----
+# ---- Generate New Cases ----
 @handle_rate_limit
-async def run_single_case(section: int):
+async def create_case_document(section: int):
+    """Generate a case file for the section and return it as a details-only document."""
     print(f"\n📂 Creating new case for Section {section}...")
     case = await generate_case(1, [section])
     
@@ -238,7 +374,7 @@ async def run_single_case(section: int):
         print(f"❌ Failed to generate case for Section {section}")
         raise ValueError("Failed to generate case")
 
-    case_data = {
+    return {
         "cnr": case["cnr"],
         "title": case["title"],
         "details": case["details"],
@@ -246,29 +382,133 @@ async def run_single_case(section: int):
         "section": section
     }
 
+async def create_cases(section: int, count: int):
+    """Generate `count` case files concurrently and store them with a single insert_many.
+
+    Returns the inserted documents (with `_id` set); failed generations are skipped.
+    """
+    generated = await asyncio.gather(
+        *(create_case_document(section) for _ in range(count)),
+        return_exceptions=True
+    )
+    for result in generated:
+        if isinstance(result, SystemExit):
+            raise result
+        if isinstance(result, BaseException):
+            print(f"❌ Error generating new case: {result}")
+    case_docs = [doc for doc in generated if isinstance(doc, dict)]
+    if not case_docs:
+        return []
+
     try:
-        result = cases_collection.insert_one(case_data)
-        case_data["_id"] = result.inserted_id
-        print(f"✅ Inserted new case {case['title']} (CNR: {case['cnr']}) into MongoDB")
+        # insert_many assigns each document's _id in place
+        await asyncio.to_thread(cases_collection.insert_many, case_docs, ordered=False)
+    except errors.BulkWriteError as e:
+        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        print(f"❌ MongoDB Insert Error for {len(failed)} of {len(case_docs)} new cases: {e}")
+        case_docs = [doc for i, doc in enumerate(case_docs) if i not in failed]
     except errors.PyMongoError as e:
         print(f"❌ MongoDB Insert Error: {e}")
-        raise
-
-    # Immediately generate arguments
-    success = await generate_arguments_for_case(case_data)
+        return []
+
+    for doc in case_docs:
+        print(f"✅ Inserted new case {doc['title']} (CNR: {doc['cnr']}) into MongoDB")
+    return case_docs
+
+# ---- Complete a Single Case ----
+async def process_case_with_retries(case: dict, label: str, max_retries: int = 2) -> bool:
+    """Generate the missing arguments for a case, retrying up to `max_retries` times."""
+    case_id = case.get('_id')
+    success = False
+    retries = 0
+    
+    while not success and retries < max_retries:
+        try:
+            print(f"{'🔄 Retrying' if retries > 0 else '🔍 Processing'} {label} case {case_id} (Attempt {retries+1}/{max_retries})")
+            try:
+                async with case_semaphore:
+                    success = await generate_arguments_for_case(case)
+            finally:
+                # Persist whatever this attempt produced before deciding what's next
+                await flush_progress()
+            
+            if success is True:
+                print(f"✅ Successfully processed {label} case {case_id}")
+                break
+            elif success is False:
+                print(f"⚠️ Case {case_id} needs another attempt")
+                retries += 1
+                # Wait a bit before retrying
+                await asyncio.sleep(5)
+            elif success is None:
+                print(f"⚠️ Case {case_id} skipped for now (initial generation failed or rate limit hit).")
+                break
+        except SystemExit:
+            # If SystemExit is raised during processing an incomplete case,
+            # it means we ran out of keys/models. Re-raise to terminate the pipeline.
+            raise
+        except Exception as e:
+            print(f"❌ Error processing {label} case {case_id}: {e}")
+            retries += 1
+            await asyncio.sleep(5)
+    
     if not success:
-        raise ValueError("Failed to generate arguments for case")
-    return True  # Return success only if everything worked
+        print(f"⛔ Failed to process {label} case {case_id} after {max_retries} attempts")
+    return success is True
+
+async def process_cases(cases: list, label: str, max_retries: int = 2):
+    """Complete several cases with a pool of CASE_CONCURRENCY workers.
+
+    Each worker takes the next case as soon as its last one finishes;
+    case_semaphore still caps the cases in flight across sections.
+    """
+    async def process(case):
+        try:
+            return await process_case_with_retries(case, label, max_retries)
+        except Exception as e:
+            print(f"❌ Error processing {label} case {case.get('_id')}: {e}")
+            return False
+
+    return await run_pool(cases, process, concurrency=CASE_CONCURRENCY)
+
+def section_status_pipeline(section: int) -> list:
+    """Aggregation bucketing a section's cases by status in one query.
+
+    Each status comes back as {"_id": status, "count": n, "docs": [...]}.
+    Resolved cases are only counted, so their documents never leave the server.
+    """
+    return [
+        {"$match": {"section": section}},
+        {"$group": {
+            "_id": "$status",
+            "count": {"$sum": 1},
+            "docs": {"$push": {"$cond": [
+                {"$eq": ["$status", "resolved"]},
+                None,
+                {
+                    "_id": "$_id",
+                    "title": "$title",
+                    "details": "$details",
+                    "plaintiff_arguments": "$plaintiff_arguments",
+                    "defendant_arguments": "$defendant_arguments"
+                }
+            ]}}
+        }},
+        {"$project": {"count": 1, "docs": {"$cond": [{"$eq": ["$_id", "resolved"]}, [], "$docs"]}}}
+    ]
 
 # ---- Run for a Single Section ----
 async def run_cases_for_section(section: int):
     # Process all cases in this order: details-only first, then in-progress, then generate new cases if needed
-    existing_cases = list(cases_collection.find({"section": section}))
-    details_only = [c for c in existing_cases if c.get("status") == "details-only"]
-    in_progress = [c for c in existing_cases if c.get("status") == "in-progress"]
-    resolved = [c for c in existing_cases if c.get("status") == "resolved"]
+    by_status = {
+        group["_id"]: group
+        for group in await asyncio.to_thread(list, cases_collection.aggregate(section_status_pipeline(section)))
+    }
+    details_only = by_status.get("details-only", {}).get("docs", [])
+    in_progress = by_status.get("in-progress", {}).get("docs", [])
+    resolved_count = by_status.get("resolved", {}).get("count", 0)
 
-    print(f"\n📊 Section {section}: {len(resolved)} resolved, {len(details_only)} details-only, {len(in_progress)} in-progress cases in DB")
+    print(f"\n📊 Section {section}: {resolved_count} resolved, {len(details_only)} details-only, {len(in_progress)} in-progress cases in DB")
 
     did_work = False  # track if we generated anything
     max_retries_per_case = 2  # Maximum number of immediate retries per case
@@ -276,142 +516,93 @@ async def run_cases_for_section(section: int):
     # First, process all details-only cases (highest priority)
     if len(details_only) > 0:
         print(f"\n🔍 Processing {len(details_only)} details-only cases for Section {section}...")
-    for case in details_only:
-        case_id = case.get('_id')
-        success = False
-        retries = 0
-        
-        while not success and retries < max_retries_per_case:
-            try:
-                print(f"{'🔄 Retrying' if retries > 0 else '🔍 Processing'} details-only case {case_id} (Attempt {retries+1}/{max_retries_per_case})")
-                success = await generate_arguments_for_case(case)
-                did_work = True
-                
-                if success is True:
-                    print(f"✅ Successfully processed details-only case {case_id}")
-                    break
-                elif success is False:
-                    print(f"⚠️ Case {case_id} needs another attempt")
-                    retries += 1
-                    # Wait a bit before retrying
-                    await asyncio.sleep(5)
-                elif success is None:
-                    print(f"⚠️ Case {case_id} skipped for now (initial generation failed or rate limit hit).")
-                    break
-            except SystemExit:
-                # If SystemExit is raised during processing an incomplete case,
-                # it means we ran out of keys/models. Re-raise to terminate the pipeline.
-                raise
-            except Exception as e:
-                print(f"❌ Error processing details-only case {case_id}: {e}")
-                retries += 1
-                await asyncio.sleep(5)
-        
-        if not success:
-            print(f"⛔ Failed to process details-only case {case_id} after {max_retries_per_case} attempts")
+        results = await process_cases(details_only, "details-only", max_retries_per_case)
+        resolved_count += sum(result is True for result in results)
+        did_work = True
     
     # Then, process all in-progress cases (second priority)
     if len(in_progress) > 0:
         print(f"\n🔍 Processing {len(in_progress)} in-progress cases for Section {section}...")
-    for case in in_progress:
-        case_id = case.get('_id')
-        success = False
+        results = await process_cases(in_progress, "in-progress", max_retries_per_case)
+        resolved_count += sum(result is True for result in results)
+        did_work = True
+
+    # Generate new cases if we haven't reached the target of 3 resolved cases
+    if resolved_count < 3:
+        needed = 3 - resolved_count
+        print(f"➡️ Generating {needed} new case(s) for Section {section}")
+        new_cases = []
         retries = 0
-        
-        while not success and retries < max_retries_per_case:
-            try:
-                print(f"{'🔄 Retrying' if retries > 0 else '🔍 Processing'} in-progress case {case_id} (Attempt {retries+1}/{max_retries_per_case})")
-                success = await generate_arguments_for_case(case)
-                did_work = True
-                
-                if success is True:
-                    print(f"✅ Successfully processed in-progress case {case_id}")
-                    break
-                elif success is False:
-                    print(f"⚠️ Case {case_id} needs another attempt")
-                    retries += 1
-                    # Wait a bit before retrying
-                    await asyncio.sleep(5)
-                elif success is None:
-                    print(f"⚠️ Case {case_id} skipped for now (initial generation failed or rate limit hit).")
-                    break
-            except SystemExit:
-                # If SystemExit is raised during processing an incomplete case,
-                # it means we ran out of keys/models. Re-raise to terminate the pipeline.
-                raise
-            except Exception as e:
-                print(f"❌ Error processing in-progress case {case_id}: {e}")
+
+        # Generate the missing case files together, then complete each one
+        while len(new_cases) < needed and retries < max_retries_per_case:
+            print(f"{'🔄 Retrying new case generation' if retries > 0 else '🆕 Generating new cases'} (Attempt {retries+1}/{max_retries_per_case})")
+            new_cases += await create_cases(section, needed - len(new_cases))
+            did_work = True
+            if len(new_cases) < needed:
                 retries += 1
                 await asyncio.sleep(5)
-        
-        if not success:
-            print(f"⛔ Failed to process in-progress case {case_id} after {max_retries_per_case} attempts")
 
-    # After attempting to complete incomplete cases, re-check their status
-    resolved_count = cases_collection.count_documents({"section": section, "status": "resolved"})
+        if len(new_cases) < needed:
+            print(f"⛔ Generated only {len(new_cases)}/{needed} new cases after {max_retries_per_case} attempts")
 
-    # Generate new cases if we haven't reached the target of 3 resolved cases
-    if resolved_count < 3:
-        for i in range(resolved_count, 3):
-            print(f"➡️ Generating new case {i+1} for Section {section}")
-            success = False
-            retries = 0
-            
-            while not success and retries < max_retries_per_case:
-                try:
-                    print(f"{'🔄 Retrying new case generation' if retries > 0 else '🆕 Generating new case'} (Attempt {retries+1}/{max_retries_per_case})")
-                    await run_single_case(section)
-                    success = True
-                    did_work = True
-                except Exception as e:
-                    print(f"❌ Error generating new case: {e}")
-                    retries += 1
-                    await asyncio.sleep(5)
-            
-            if not success:
-                print(f"⛔ Failed to generate new case after {max_retries_per_case} attempts")
-                break
+        await process_cases(new_cases, "new", max_retries_per_case)
 
     # ⏳ Only wait if something was done
     if did_work:
         print(f"⏳ Waiting 10 seconds before next section...")
-        time.sleep(10)
+        await asyncio.sleep(10)
 
 # ---- Run for All Sections ----
+async def run_sections(sections: list):
+    """Run several sections concurrently, at most SECTION_CONCURRENCY at a time."""
+    semaphore = asyncio.Semaphore(SECTION_CONCURRENCY)
+
+    async def run(section):
+        async with semaphore:
+            await run_cases_for_section(section)
+
+    await asyncio.gather(*(run(section) for section in sections))
+
 async def run_pipeline():
     # Print initial rotation status
     initial_stats = print_initial_rotation_status()
     
-    # First, identify sections with incomplete cases
-    sections_with_incomplete = []
-    for section in ipc_sections:
-        incomplete_count = cases_collection.count_documents({
-            "section": section, 
-            "status": {"$in": ["details-only", "in-progress"]}
-        })
-        if incomplete_count > 0:
-            sections_with_incomplete.append((section, incomplete_count))
+    await asyncio.to_thread(ensure_indexes)
+
+    # First, identify sections with incomplete cases in a single aggregation
+    incomplete_counts = await asyncio.to_thread(list, cases_collection.aggregate([
+        {"$match": {"status": {"$in": ["details-only", "in-progress"]}, "section": {"$in": ipc_sections}}},
+        {"$group": {"_id": "$section", "count": {"$sum": 1}}}
+    ]))
+    sections_with_incomplete = [(doc["_id"], doc["count"]) for doc in incomplete_counts]
     
     # Sort sections by number of incomplete cases (highest first)
     sections_with_incomplete.sort(key=lambda x: x[1], reverse=True)
     sections_to_process_first = [section for section, _ in sections_with_incomplete]
+
+    flusher = asyncio.create_task(periodic_flush())
     
-    # Process sections with incomplete cases first
-    if sections_to_process_first:
-        print(f"\n🔄 Processing {len(sections_to_process_first)} sections with incomplete cases first...")
-        for section in sections_to_process_first:
-            await run_cases_for_section(section)
-    
-    # Then process remaining sections
-    remaining_sections = [s for s in ipc_sections if s not in sections_to_process_first]
-    if remaining_sections:
-        print(f"\n🆕 Processing {len(remaining_sections)} remaining sections...")
-        for section in remaining_sections:
-            await run_cases_for_section(section)
-    
+    try:
+        # Process sections with incomplete cases first
+        if sections_to_process_first:
+            print(f"\n🔄 Processing {len(sections_to_process_first)} sections with incomplete cases first...")
+            await run_sections(sections_to_process_first)
+
+        # Then process remaining sections
+        remaining_sections = [s for s in ipc_sections if s not in sections_to_process_first]
+        if remaining_sections:
+            print(f"\n🆕 Processing {len(remaining_sections)} remaining sections...")
+            await run_sections(remaining_sections)
+    finally:
+        # Don't lose queued progress, even if the run is aborted
+        flusher.cancel()
+        await flush_progress()
+
     # Print final rotation status
     print("\n🏁 Pipeline run completed!")
     print_final_rotation_status(initial_stats)
 
 if __name__ == "__main__":
+    setup_logging()
     asyncio.run(run_pipeline())
@@ -0,0 +1,169 @@
+# pipeline_batch.py
+import asyncio
+import re
+import sys
+import httpx
+import orjson
+from bson import ObjectId
+from pymongo import errors
+from pymongo.operations import UpdateOne
+from llm import TEMPERATURE
+from llm_manager import get_current_key, get_current_model
+from lawyer import STAGE_PROMPTS, is_valid_response
+from pipeline import cases_collection
+from db_client import get_client
+from logging_setup import setup_logging
+
+# Groq's OpenAI-compatible API; batch jobs are billed at half the synchronous price
+GROQ_API_URL = "https://api.groq.com/openai/v1"
+COMPLETION_WINDOW = "24h"
+MAX_TOKENS = 2048  # Same cap as build_llm
+
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+
+# LangChain message types to OpenAI chat roles
+_CHAT_ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+# Cases that are still missing at least one opening statement
+PENDING_OPENINGS = {
+    "status": {"$ne": "resolved"},
+    "$or": [
+        {"plaintiff_arguments.0": {"$exists": False}},
+        {"defendant_arguments.0": {"$exists": False}}
+    ]
+}
+
+def build_requests(cases: list, model: str) -> list:
+    """One batch line per missing opening statement, rendered from the lawyer prompt."""
+    lines = []
+    for case in cases:
+        for side, opponent in (("Plaintiff", "Defendant"), ("Defendant", "Plaintiff")):
+            if case.get(f"{side.lower()}_arguments"):
+                continue
+            messages = STAGE_PROMPTS["opening"].format_messages(
+                ai_role=side, case_details=case["details"], user_role=opponent
+            )
+            lines.append({
+                "custom_id": f"{case['_id']}:opening:{side.lower()}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "temperature": TEMPERATURE,
+                    "max_tokens": MAX_TOKENS,
+                    "messages": [{"role": _CHAT_ROLES[m.type], "content": m.content} for m in messages]
+                }
+            })
+    return lines
+
+async def submit_batch(client: httpx.AsyncClient, lines: list) -> dict:
+    """Upload the request lines as a JSONL file and start a batch job over it."""
+    payload = b"\n".join(orjson.dumps(line) for line in lines)
+    upload = await client.post(
+        "/files",
+        data={"purpose": "batch"},
+        files={"file": ("openings.jsonl", payload, "application/jsonl")}
+    )
+    upload.raise_for_status()
+
+    response = await client.post("/batches", json={
+        "input_file_id": upload.json()["id"],
+        "endpoint": "/v1/chat/completions",
+        "completion_window": COMPLETION_WINDOW
+    })
+    response.raise_for_status()
+    return response.json()
+
+async def wait_for_batch(client: httpx.AsyncClient, batch_id: str, delay: float = 30, max_delay: float = 600) -> dict:
+    """Poll a batch with exponential backoff until it reaches a final status."""
+    while True:
+        response = await client.get(f"/batches/{batch_id}")
+        response.raise_for_status()
+        batch = response.json()
+        if batch["status"] in ("completed", "failed", "expired", "cancelled"):
+            return batch
+
+        print(f"⏳ Batch {batch_id} is {batch['status']}; checking again in {delay:.0f}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+async def fetch_results(client: httpx.AsyncClient, file_id: str) -> list:
+    response = await client.get(f"/files/{file_id}/content")
+    response.raise_for_status()
+    return [orjson.loads(line) for line in response.content.splitlines() if line.strip()]
+
+def result_updates(results: list) -> list:
+    """UpdateOne ops that store each valid opening statement.
+
+    An opening is only pushed while that side has no arguments yet, so
+    applying the same batch twice, or after pipeline.py has filled the case
+    in, never duplicates it.
+    """
+    ops = []
+    for result in results:
+        case_id, _, side = result["custom_id"].split(":")
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            print(f"❌ {result['custom_id']} failed: {result.get('error') or response.get('body')}")
+            continue
+
+        text = _THINK_RE.sub("", response["body"]["choices"][0]["message"]["content"]).strip()
+        if not is_valid_response(text):
+            print(f"⚠️ {result['custom_id']} returned no valid opening statement")
+            continue
+
+        field = f"{side}_arguments"
+        ops.append(UpdateOne(
+            {"_id": ObjectId(case_id), f"{field}.0": {"$exists": False}},
+            {"$push": {field: text}, "$set": {"status": "in-progress"}}
+        ))
+    return ops
+
+async def run_batch(batch_id: str = None):
+    """Batch-generate every missing opening statement, or finish an already submitted batch.
+
+    Only openings go through the batch: each counter-argument answers the one
+    before it, so run pipeline.py afterwards to complete the cases.
+    """
+    # Batches and their files belong to the key that created them
+    async with httpx.AsyncClient(
+        base_url=GROQ_API_URL,
+        headers={"Authorization": f"Bearer {get_current_key()}"},
+        timeout=120
+    ) as client:
+        if batch_id is None:
+            cases = await asyncio.to_thread(list, cases_collection.find(
+                PENDING_OPENINGS, {"details": 1, "plaintiff_arguments": 1, "defendant_arguments": 1}
+            ))
+            lines = build_requests(cases, get_current_model())
+            if not lines:
+                print("✅ No cases are missing opening statements")
+                return
+
+            batch = await submit_batch(client, lines)
+            batch_id = batch["id"]
+            print(f"📤 Submitted batch {batch_id} with {len(lines)} opening statements for {len(cases)} cases")
+            print(f"   (resume with: python pipeline_batch.py {batch_id})")
+
+        batch = await wait_for_batch(client, batch_id)
+        if batch["status"] != "completed" or not batch.get("output_file_id"):
+            print(f"❌ Batch {batch_id} ended as {batch['status']} without results")
+            return
+
+        ops = result_updates(await fetch_results(client, batch["output_file_id"]))
+
+    if not ops:
+        print(f"⚠️ Batch {batch_id} produced no usable opening statements")
+        return
+    try:
+        result = await asyncio.to_thread(cases_collection.bulk_write, ops, ordered=False)
+        print(f"💾 Saved {result.modified_count} opening statements from batch {batch_id}")
+    except errors.PyMongoError as e:
+        print(f"❌ MongoDB Update Error: {e}")
+
+if __name__ == "__main__":
+    setup_logging()
+    try:
+        asyncio.run(run_batch(sys.argv[1] if len(sys.argv) > 1 else None))
+    finally:
+        get_client().close()
@@ -1,36 +1,157 @@
 # verdict_generation.py
 import asyncio
-import os
 import argparse
-from pymongo import MongoClient
+import itertools
+import logging
+import os
+import socket
+import sys
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from bson import ObjectId
-from dotenv import load_dotenv
-from judge import generate_verdict
-from llm_manager import get_all_models, set_current_model
+from pymongo import errors
+from pymongo.operations import UpdateOne
+from judge import VERDICT_UNAVAILABLE, build_prompt, generate_verdict
+from llm_manager import get_all_models, get_current_key
 import llm
+from llm_cache import make_key
+from db_client import get_db
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
 
-# Load Environment Variables
-load_dotenv()
-MONGODB_URL = os.getenv("MONGODB_URL")
-DB_NAME = "ai_courtroom"
 CASES_COLLECTION_NAME = "cases"
 VERDICTS_COLLECTION_NAME = "verdicts"
+CLAIMS_COLLECTION_NAME = "verdict_claims"
+VERDICT_CACHE_COLLECTION_NAME = "verdict_cache"
 
-# Connect to MongoDB
-client = MongoClient(MONGODB_URL)
-db = client[DB_NAME]
-cases_collection = db[CASES_COLLECTION_NAME]
-verdicts_collection = db[VERDICTS_COLLECTION_NAME]
+# A claim on a (case, model) verdict lapses after this long, so pairs held by
+# a worker that crashed are picked up again by later runs
+CLAIM_TTL = int(os.getenv("VERDICT_CLAIM_TTL", "1800"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
-async def generate_and_save_verdict(case_id, model_name):
+# Verdict LLM calls in flight at once, across all cases and models
+VERDICT_CONCURRENCY = int(os.getenv("VERDICT_CONCURRENCY", "8"))
+verdict_semaphore = asyncio.Semaphore(VERDICT_CONCURRENCY)
+
+WRITE_BATCH_SIZE = 100  # Verdicts written per bulk_write
+
+STREAM_BATCH_SIZE = 200  # Cases read from the cursor at a time
+
+# Case fields a verdict is generated from
+CASE_FIELDS = {"status": 1, "title": 1, "section": 1, "details": 1, "plaintiff_arguments": 1, "defendant_arguments": 1}
+
+@lru_cache(maxsize=1)
+def get_collections():
+    """(cases, verdicts) collections on the shared client, resolved on first use
+    so importing this module doesn't touch MongoDB."""
+    db = get_db()
+    return db[CASES_COLLECTION_NAME], db[VERDICTS_COLLECTION_NAME]
+
+@lru_cache(maxsize=1)
+def get_claims_collection():
+    """Collection of in-flight (case, model) claims shared by concurrent workers."""
+    return get_db()[CLAIMS_COLLECTION_NAME]
+
+@lru_cache(maxsize=1)
+def get_verdict_cache_collection():
+    """Verdicts keyed by (model, rendered prompt), shared by every run and worker."""
+    return get_db()[VERDICT_CACHE_COLLECTION_NAME]
+
+def prompt_key(model_name, prompt):
+    """Cache key for a model's answer to a rendered judge prompt."""
+    return make_key({
+        "model": model_name,
+        "temperature": llm.TEMPERATURE,
+        "messages": [(message.type, message.content) for message in prompt],
+    })
+
+async def fetch_cached_verdicts(keys):
+    """Cached verdicts for a batch of prompt keys, in one query; cache errors count as misses."""
+    try:
+        docs = await asyncio.to_thread(
+            list, get_verdict_cache_collection().find({"_id": {"$in": keys}}, {"verdict": 1})
+        )
+    except errors.PyMongoError as e:
+        logger.warning("⚠️ Verdict cache lookup failed: %s", e)
+        return {}
+    return {doc["_id"]: doc["verdict"] for doc in docs}
+
+async def cache_verdicts(entries):
+    """Store (prompt key, model, verdict) entries with one unordered bulk_write."""
+    if not entries:
+        return
+    ops = [
+        UpdateOne({"_id": key}, {"$setOnInsert": {"model_name": model_name, "verdict": verdict}}, upsert=True)
+        for key, model_name, verdict in entries
+    ]
+    try:
+        await asyncio.to_thread(get_verdict_cache_collection().bulk_write, ops, ordered=False)
+    except errors.PyMongoError as e:
+        logger.warning("⚠️ Could not cache %d verdict(s): %s", len(entries), e)
+
+# Model names made safe for verdict _ids, computed once per model
+SANITIZED_MODELS = {model: model.replace('/', '_') for model in get_all_models()}
+
+def verdict_id(case_oid, model_name):
+    """_id of the verdict a model gives for a case: "<case id>_<sanitized model>"."""
+    sanitized = SANITIZED_MODELS.get(model_name) or model_name.replace('/', '_')
+    return f"{case_oid}_{sanitized}"
+
+def ensure_indexes():
+    """Index verdicts by case and model; serves the $lookup in generate_verdicts_for_n_cases."""
+    _, verdicts_collection = get_collections()
+    try:
+        verdicts_collection.create_index([("case_ref", 1), ("model_name", 1)], unique=True)
+    except errors.OperationFailure as e:
+        # Existing duplicate verdicts block the unique index; lookups still work without it
+        logger.warning("⚠️ Could not create unique index on verdicts: %s", e)
+    # MongoDB deletes lapsed claims by itself
+    get_claims_collection().create_index("claimed_at", expireAfterSeconds=CLAIM_TTL)
+
+def claim_verdict(verdict_doc_id):
+    """Atomically claim a verdict for this worker; False if another worker holds a live claim.
+
+    The upsert only matches a missing or lapsed claim. A live claim makes it
+    try to insert a second document with the same _id, which fails.
     """
-    Generate a verdict for a specific case and save it to the verdicts collection.
+    now = datetime.now(timezone.utc)
+    try:
+        get_claims_collection().update_one(
+            {"_id": verdict_doc_id, "claimed_at": {"$lt": now - timedelta(seconds=CLAIM_TTL)}},
+            {"$set": {"worker": WORKER_ID, "claimed_at": now}},
+            upsert=True
+        )
+        return True
+    except errors.DuplicateKeyError:
+        return False
+
+def release_claims():
+    """Drop every claim this worker holds."""
+    get_claims_collection().delete_many({"worker": WORKER_ID})
+
+def verdict_inputs(case):
+    """(plaintiff args, defendant args, details, title) a verdict is generated from."""
+    return (
+        case.get("plaintiff_arguments", []),
+        case.get("defendant_arguments", []),
+        case.get("details", ""),
+        case.get("title", "Untitled Case"),
+    )
+
+async def generate_verdict_doc(case_id, model_name, case=None, prompt=None, verdict=None):
+    """
+    Generate a verdict for a specific case without saving it.
     
     Args:
         case_id: The ObjectId of the case to generate a verdict for
+        case: The case document, if already fetched (with CASE_FIELDS)
+        prompt: The case's judge prompt, if already rendered (shared across models)
+        verdict: A verdict this model already gave for the same prompt; skips the LLM call
         
     Returns:
-        The generated verdict or None if case not found or error occurred
+        The verdict document for the verdicts collection, or None if case not found or error occurred
     """
     try:
         # Convert string ID to ObjectId if needed
@@ -38,43 +159,48 @@ async def generate_and_save_verdict(case_id, model_name):
             case_id = ObjectId(case_id)
             
         # Retrieve the case from MongoDB
-        case = cases_collection.find_one({"_id": case_id})
+        if case is None:
+            cases_collection, _ = get_collections()
+            case = await asyncio.to_thread(cases_collection.find_one, {"_id": case_id}, CASE_FIELDS)
         
         if not case:
-            print(f"❌ Case with ID {case_id} not found")
+            logger.error("❌ Case with ID %s not found", case_id)
             return None
             
         # Check if case is resolved (has all arguments)
         if case.get("status") != "resolved":
-            print(f"⚠️ Case {case_id} is not resolved yet. Status: {case.get('status')}")
+            logger.warning("⚠️ Case %s is not resolved yet. Status: %s", case_id, case.get('status'))
             return None
             
         # Extract required data for verdict generation
-        plaintiff_args = case.get("plaintiff_arguments", [])
-        defendant_args = case.get("defendant_arguments", [])
-        case_details = case.get("details", "")
+        plaintiff_args, defendant_args, case_details, case_title = verdict_inputs(case)
         section = case.get("section", "")
-        case_title = case.get("title", "Untitled Case")
         
-        print(f"🧑‍⚖️ Generating verdict for case: {case_title} (ID: {case_id})")
+        logger.debug("🧑‍⚖️ Generating verdict for case: %s (ID: %s) with %s", case_title, case_id, model_name)
         
-        # Generate the verdict
-        llm_instance = llm.get_llm()
-        verdict = await generate_verdict(
-            plaintiff_args,
-            defendant_args,
-            case_details,
-            case_title,
-            llm_instance
-        )
-        
-        if not verdict:
-            print(f"❌ Failed to generate verdict for case {case_id}")
-            return None
+        if verdict is None:
+            # Generate the verdict; the model is bound per call so concurrent
+            # tasks for different models never share the global current model
+            llm_instance = llm.build_llm(model_name, get_current_key(), cached=True)
+            async with verdict_semaphore:
+                verdict = await generate_verdict(
+                    plaintiff_args,
+                    defendant_args,
+                    case_details,
+                    case_title,
+                    llm_instance,
+                    prompt=prompt
+                )
+
+            if not verdict or verdict == VERDICT_UNAVAILABLE:
+                logger.error("❌ Failed to generate verdict for case %s", case_id)
+                return None
+        else:
+            logger.debug("♻️ Reusing cached verdict for case %s with %s", case_id, model_name)
             
-        # Save the verdict and complete case to the verdicts collection
-        verdict_doc = {
-            "_id": f"{str(case['_id'])}_{model_name.replace('/', '_')}",
+        # The verdict together with the complete case, for the verdicts collection
+        return {
+            "_id": verdict_id(case['_id'], model_name),
             "case_ref": case['_id'],
             "case_title": case_title,
             "section": section,
@@ -83,14 +209,51 @@ async def generate_and_save_verdict(case_id, model_name):
             "model_name": model_name
         }
         
-        result = verdicts_collection.insert_one(verdict_doc)
-        print(f"✅ Saved verdict for case {case_title} (ID: {case_id}) to verdicts collection")
-
-        return verdict
-        
     except Exception as e:
-        print(f"❌ Error generating verdict for case {case_id}: {str(e)}")
+        logger.error("❌ Error generating verdict for case %s: %s", case_id, e)
+        return None
+
+async def generate_and_save_verdict(case_id, model_name):
+    """
+    Generate a verdict for a specific case and save it to the verdicts collection.
+    
+    Returns:
+        The generated verdict or None if case not found or error occurred
+    """
+    verdict_doc = await generate_verdict_doc(case_id, model_name)
+    if not verdict_doc:
+        return None
+    saved, _ = await save_verdicts([verdict_doc])
+    if not saved:
         return None
+    logger.info("✅ Saved verdict for case %s (ID: %s) to verdicts collection", verdict_doc['case_title'], case_id)
+    return verdict_doc["verdict"]
+
+async def save_verdicts(verdict_docs):
+    """Upsert a batch of verdict documents with one unordered bulk_write.
+
+    Callers pass at most WRITE_BATCH_SIZE documents at a time. Re-saving a
+    verdict that already exists just overwrites it. Returns how many were
+    saved and the case ids of verdicts that are not stored.
+    """
+    if not verdict_docs:
+        return 0, set()
+    _, verdicts_collection = get_collections()
+    ops = [
+        UpdateOne({"_id": doc["_id"]}, {"$set": {k: v for k, v in doc.items() if k != "_id"}}, upsert=True)
+        for doc in verdict_docs
+    ]
+    try:
+        result = await asyncio.to_thread(verdicts_collection.bulk_write, ops, ordered=False)
+        return result.upserted_count + result.matched_count, set()
+    except errors.BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        logger.error("❌ %d verdict(s) could not be saved: %s", len(write_errors), e)
+        saved = e.details.get("nUpserted", 0) + e.details.get("nMatched", 0)
+        return saved, {verdict_docs[error["index"]]["case_ref"] for error in write_errors}
+    except errors.PyMongoError as e:
+        logger.error("❌ MongoDB Write Error: %s", e)
+        return 0, {doc["case_ref"] for doc in verdict_docs}
 
 async def generate_verdicts_for_n_cases(n=None):
     """
@@ -102,60 +265,162 @@ async def generate_verdicts_for_n_cases(n=None):
     Returns:
         Number of verdicts successfully generated
     """
-    # Find resolved cases that don't have verdicts yet
-    # Find resolved cases that don't have verdicts yet
-    cases_needing_verdicts = list(cases_collection.find({"status": "resolved"}))
+    cases_collection, _ = get_collections()
+    await asyncio.to_thread(ensure_indexes)
 
-    # Filter out cases that already have verdicts for all models
+    # Find resolved cases still missing a verdict from some model, joining
+    # each case to the models of its existing verdicts on the server
     all_models = get_all_models()
-    cases_to_process = []
-    for case in cases_needing_verdicts:
-        case_id = str(case["_id"])
-        existing_verdicts = verdicts_collection.find({"case_id": case_id}, {"model_name": 1})
-        generated_models = {v.get("model_name") for v in existing_verdicts if v.get("model_name")}
-        
-        # Check if all models have generated a verdict for this case
-        if not all(model in generated_models for model in all_models):
-            cases_to_process.append(case)
-    
-    print(f"📊 Found {len(cases_needing_verdicts)} resolved cases without verdicts")
-    
+    pipeline = [
+        {"$match": {"status": "resolved"}},
+        {"$project": {"_id": 1}},
+        {"$lookup": {
+            "from": VERDICTS_COLLECTION_NAME,
+            "let": {"case_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$case_ref", "$$case_id"]}}},
+                {"$project": {"_id": 0, "model_name": 1}}
+            ],
+            "as": "verdicts"
+        }},
+        {"$project": {"models": "$verdicts.model_name"}},
+        {"$match": {"models": {"$not": {"$all": all_models}}}}
+    ]
     # Limit to the requested number if n is provided
     if n is not None:
-        cases_to_process = cases_to_process[:n]
-    
-    if not cases_to_process:
-        print("ℹ️ No cases found that need verdicts")
+        pipeline.append({"$limit": n})
+    # aggregate() runs the $lookup and fetches the first batch, so keep it off the event loop
+    cursor = await asyncio.to_thread(cases_collection.aggregate, pipeline, batchSize=STREAM_BATCH_SIZE)
+
+    # Stream the cases a batch at a time into a bounded queue of (case, model)
+    # pairs, so generation starts with the first batch and memory stays bounded
+    queue = asyncio.Queue(maxsize=VERDICT_CONCURRENCY * 2)
+    found = 0  # Cases read from the cursor
+    pending = []  # Generated verdicts not written yet
+    pending_cache = []  # (prompt key, model, verdict) of new verdicts not cached yet
+    expected = Counter()  # Verdicts queued per case
+    generated = Counter()  # Verdicts generated per case
+    unsaved_cases = set()
+    saved = 0
+
+    async def flush():
+        nonlocal saved
+        if not pending:
+            return
+        # Take the batch before awaiting, so other workers keep appending to a fresh one
+        batch, cache_batch = pending[:], pending_cache[:]
+        pending.clear()
+        pending_cache.clear()
+        (batch_saved, batch_unsaved), _ = await asyncio.gather(save_verdicts(batch), cache_verdicts(cache_batch))
+        saved += batch_saved
+        unsaved_cases.update(batch_unsaved)
+        logger.info("💾 Saved %d of %d verdicts", batch_saved, len(batch))
+
+    async def produce():
+        nonlocal found
+        while True:
+            batch = await asyncio.to_thread(list, itertools.islice(cursor, STREAM_BATCH_SIZE))
+            if not batch:
+                return
+            found += len(batch)
+            if found == len(batch):
+                logger.info("🧑‍⚖️ Generating verdicts for resolved cases without verdicts...")
+
+            # Fetch each case that needs work once, for all of its models
+            cases = {
+                case["_id"]: case
+                for case in await asyncio.to_thread(
+                    list, cases_collection.find({"_id": {"$in": [case["_id"] for case in batch]}}, CASE_FIELDS)
+                )
+            }
+            # Queue model by model, cases of a section together, so consecutive
+            # calls hit the same model endpoint with similar prompts and the
+            # provider's warm prefix cache
+            batch.sort(key=lambda case: str(cases.get(case["_id"], {}).get("section", "")))
+            # Render each case's judge prompt once, for all of its models
+            prompts = {case_id: build_prompt(*verdict_inputs(case)) for case_id, case in cases.items()}
+            # Verdicts a model already gave for the same prompt, e.g. before a crash,
+            # fetched for the whole batch in one query
+            keys = {
+                (case["_id"], model_name): prompt_key(model_name, prompts[case["_id"]])
+                for case in batch if case["_id"] in prompts
+                for model_name in all_models if model_name not in case["models"]
+            }
+            hits = await fetch_cached_verdicts(list(keys.values()))
+            for model_name in all_models:
+                for case in batch:
+                    case_id = case["_id"]
+                    if model_name in case["models"]:
+                        logger.debug("ℹ️ Verdict already exists for case %s with model %s. Skipping.", case_id, model_name)
+                        continue
+                    expected[case_id] += 1
+                    key = keys.get((case_id, model_name))
+                    await queue.put((case_id, model_name, cases.get(case_id), prompts.get(case_id), key, hits.get(key)))
+
+    async def process(item):
+        case_id, model_name, case, prompt, key, cached = item
+        # A cached verdict costs no LLM call, so it is not worth a claim
+        if cached is None and not await asyncio.to_thread(claim_verdict, verdict_id(case_id, model_name)):
+            logger.debug("ℹ️ Case %s with model %s is claimed by another worker. Skipping.", case_id, model_name)
+            return
+        verdict_doc = await generate_verdict_doc(case_id, model_name, case, prompt, cached)
+        if verdict_doc:
+            pending.append(verdict_doc)
+            if cached is None and key:
+                pending_cache.append((key, model_name, verdict_doc["verdict"]))
+            generated[case_id] += 1
+            # Write as we go, well within the claims' TTL
+            if len(pending) >= WRITE_BATCH_SIZE:
+                await flush()
+
+    async def consume():
+        # At most VERDICT_CONCURRENCY verdicts are generated at a time
+        while (item := await queue.get()) is not None:
+            # A failed item must not stop the worker: with every worker gone,
+            # produce() would block on the full queue forever
+            try:
+                await process(item)
+            except Exception as e:
+                logger.error("❌ Error processing case %s with model %s: %s", item[0], item[1], e)
+
+    workers = [asyncio.create_task(consume()) for _ in range(VERDICT_CONCURRENCY)]
+    try:
+        await produce()
+    finally:
+        try:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            cursor.close()
+            # Keep what was generated even if the run failed
+            try:
+                await flush()
+            finally:
+                # Saved verdicts are skipped by the lookup; failed pairs are free for other workers
+                await asyncio.to_thread(release_claims)
+
+    logger.info("📊 Found %d resolved cases without verdicts", found)
+    if not found:
+        logger.info("ℹ️ No cases found that need verdicts")
         return 0
-        
-    print(f"🧑‍⚖️ Generating verdicts for {len(cases_to_process)} cases...")
-    
-    # Generate verdicts for each case
-    successful_verdicts = 0
-    for case in cases_to_process:
-        case_id = case["_id"]
-        for model_name in all_models:
-            # Check if verdict already exists for this case and model
-            verdict_doc_id = f"{case_id}_{model_name.replace('/', '_')}"
-            if verdicts_collection.find_one({"_id": verdict_doc_id}):
-                print(f"ℹ️ Verdict already exists for case {case_id} with model {model_name}. Skipping.")
-                continue
-
-            set_current_model(model_name)
-            print(f"🔄 Generating verdict for case {case_id} using model: {model_name}")
-            verdict = await generate_and_save_verdict(case_id, model_name)
-            if verdict:
-                successful_verdicts += 1
-
-        # Update the original case with a flag indicating verdict generation
-        cases_collection.update_one(
-            {"_id": case_id},
+    logger.info("💾 Saved %d of %d generated verdicts", saved, sum(generated.values()))
+
+    # Flag the cases that now have a verdict from every model, in one update
+    done_ids = [
+        case_id for case_id, count in expected.items()
+        if generated[case_id] == count and case_id not in unsaved_cases
+    ]
+    if done_ids:
+        await asyncio.to_thread(
+            cases_collection.update_many,
+            {"_id": {"$in": done_ids}},
             {"$set": {"verdict_generated": True}}
         )
-        print(f"✅ Updated case {case_id} with verdict_generated flag")
-            
-    print(f"✅ Successfully generated {successful_verdicts} verdicts")
-    return successful_verdicts
+        logger.info("✅ Updated %d case(s) with verdict_generated flag", len(done_ids))
+
+    logger.info("✅ Successfully generated %d verdicts", saved)
+    return saved
 
 # Command-line interface
 if __name__ == "__main__":
@@ -169,9 +434,22 @@ if __name__ == "__main__":
         help="Number of cases to generate verdicts for. If not specified, all unprocessed cases will be evaluated."
     )
     args = parser.parse_args()
+    setup_logging()
+
+    # uvloop speeds up the socket-heavy Mongo/LLM traffic; not available on Windows
+    run_options = {}
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+    if uvloop is not None:
+        if sys.version_info >= (3, 12):
+            run_options["loop_factory"] = uvloop.new_event_loop
+        else:
+            uvloop.install()  # Deprecated from 3.12, where asyncio.run takes a loop_factory
 
     try:
-        asyncio.run(generate_verdicts_for_n_cases(args.num_cases))
+        asyncio.run(generate_verdicts_for_n_cases(args.num_cases), **run_options)
     except Exception as e:
-        print(f"Error: {str(e)}")
+        logger.error("Error: %s", e)
         sys.exit(1)
\ No newline at end of file